@@ -0,0 +1,78 @@
+import time
+import logging
+from collections import deque
+
+# Rough generation speeds used for a model until it has served a few requests.
+DEFAULT_TOKENS_PER_SEC = {
+    '117M': 40.0,
+    '345M': 15.0,
+    '774M': 7.0,
+    '1558M': 3.0,
+}
+
+# Prompt length assumed for a configuration until prompts have been seen.
+DEFAULT_PROMPT_TOKENS = 32
+
+class AdmissionControl:
+    """Estimates how long a generation will take from measured tokens/sec per model,
+    and accepts or rejects work based on that estimate and what is already running."""
+
+    def __init__(self, max_request_seconds=120, warn_seconds=30, window=20, prefill_cost=0.1):
+        self.max_request_seconds = max_request_seconds
+        self.warn_seconds = warn_seconds
+        self.window = window
+        # A prompt token is prefilled in parallel, so it costs a fraction of a generated one.
+        self.prefill_cost = prefill_cost
+        self.samples = {}
+        self.prompts = deque(maxlen=window)
+        self.inflight = {}
+        self.next_job = 0
+
+    def tokens_per_sec(self, model_name):
+        history = self.samples.get(model_name)
+        if not history:
+            return DEFAULT_TOKENS_PER_SEC.get(model_name, 1.0)
+        tokens = sum(t for t, _ in history)
+        seconds = sum(s for _, s in history)
+        return tokens / max(seconds, 1e-6)
+
+    def cost(self, length, prompt_tokens=0):
+        return length + prompt_tokens * self.prefill_cost
+
+    def estimate(self, model_name, nsamples, length, prompt_tokens=0):
+        """Seconds needed to generate nsamples samples of length tokens after a prompt."""
+        return nsamples * self.cost(length, prompt_tokens) / self.tokens_per_sec(model_name)
+
+    def record(self, model_name, length, seconds, prompt_tokens=0):
+        if seconds <= 0:
+            return
+        history = self.samples.setdefault(model_name, deque(maxlen=self.window))
+        history.append((self.cost(length, prompt_tokens), seconds))
+        if prompt_tokens:
+            self.prompts.append(prompt_tokens)
+        logging.info('THROUGHPUT ' + model_name + ': ' + str(round(self.tokens_per_sec(model_name), 2)) + ' tokens/sec.')
+
+    def typical_prompt_tokens(self):
+        if not self.prompts:
+            return DEFAULT_PROMPT_TOKENS
+        return sum(self.prompts) / len(self.prompts)
+
+    def queue_seconds(self):
+        """Estimated seconds until everything currently running is done."""
+        now = time.time()
+        return sum(max(estimate - (now - started), 0) for started, estimate in self.inflight.values())
+
+    def start(self, estimate):
+        job = self.next_job
+        self.next_job += 1
+        self.inflight[job] = (time.time(), estimate)
+        return job
+
+    def finish(self, job):
+        self.inflight.pop(job, None)
+
+    def check_config(self, model_name, nsamples, length):
+        """Returns (accepted, estimated seconds per request) for a session configuration,
+        for a prompt of typical length."""
+        estimate = self.estimate(model_name, nsamples, length, self.typical_prompt_tokens())
+        return estimate <= self.max_request_seconds, estimate
@@ -0,0 +1,122 @@
+#!/usr/bin/python3
+"""Generate completions for many prompts offline.
+
+Reads one JSON object per line, e.g. {"id": 1, "prompt": "Hello"}, from a file or stdin
+and writes one JSON object per line with the generated text and its timing. An empty
+prompt asks for an unconditional sample. Prompts are read in buffers, sorted by token
+length and batched; results come out in batch order, match them up by id.
+
+By default only prompts of the same token length share a batch, so every output is what
+the prompt would give on its own. --max-padding N lets prompts up to N tokens shorter
+join a batch by left padding them with <|endoftext|>. The model has no attention mask,
+so it reads that padding as text: faster, but a padded prompt's output then depends on
+which prompts it was batched with, which is no good for comparing runs.
+
+    python3 batch_generate.py --model 345M --length 100 --batch-size 8 prompts.jsonl > out.jsonl
+"""
+import sys
+import json
+import time
+import logging
+import argparse
+from gpt2_server_sessions import gpt2_server_sessions
+from bot_config import load_bot_config
+
+def read_prompts(lines, buffer_size):
+    """Yield lists of up to buffer_size (line number, request) pairs."""
+    buffer = []
+    for i, line in enumerate(lines):
+        line = line.strip()
+        if not line:
+            continue
+        buffer.append((i, json.loads(line)))
+        if len(buffer) >= buffer_size:
+            yield buffer
+            buffer = []
+    if buffer:
+        yield buffer
+
+def make_batches(items, batch_size, max_padding):
+    """Split (tokens, item) pairs into batches of similar length.
+
+    Items are sorted by token count and a batch is closed when it is full or when the
+    next item would need more than max_padding tokens of padding on the shortest one.
+    """
+    batches = []
+    batch = []
+    for tokens, item in sorted(items, key=lambda pair: len(pair[0])):
+        if batch and (len(batch) == batch_size or len(tokens) - len(batch[0][0]) > max_padding):
+            batches.append(batch)
+            batch = []
+        batch.append((tokens, item))
+    if batch:
+        batches.append(batch)
+    return batches
+
+def pad_batch(batch, pad_token):
+    """Left pad every context to the longest one. The padding is attended to like any
+    other token, see --max-padding."""
+    width = max(len(tokens) for tokens, _ in batch)
+    contexts = [[pad_token] * (width - len(tokens)) + tokens for tokens, _ in batch]
+    padding = sum(width - len(tokens) for tokens, _ in batch)
+    return contexts, padding
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate GPT-2 samples for a JSONL file of prompts')
+    parser.add_argument('input', nargs='?', default='-', help='JSONL file of prompts, - for stdin')
+    parser.add_argument('--output', default='-', help='JSONL file to write, - for stdout')
+    parser.add_argument('--model', default='117M')
+    parser.add_argument('--length', type=int, default=200)
+    parser.add_argument('--temperature', type=float, default=1)
+    parser.add_argument('--top-k', type=int, default=40)
+    parser.add_argument('--batch-size', type=int, default=8, help='Most prompts generated at once')
+    parser.add_argument('--max-padding', type=int, default=0,
+        help='Padding tokens allowed on a prompt before starting a new batch. Padding changes the output, see above')
+    parser.add_argument('--buffer', type=int, default=256, help='Prompts read ahead and sorted by length at once')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    session = gpt2_server_sessions('batch', config={
+        'model_name': args.model,
+        'length': args.length,
+        'temperature': args.temperature,
+        'top_k': args.top_k,
+        'batch_size': args.batch_size,
+    }, bot_config=load_bot_config())
+    end_token = session.enc.encoder['<|endoftext|>']
+
+    source = sys.stdin if args.input == '-' else open(args.input, 'r', encoding='utf-8')
+    sink = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8')
+    batch_number = 0
+    for buffer in read_prompts(source, args.buffer):
+        items = []
+        for line_number, request in buffer:
+            prompt = request.get('prompt', '')
+            tokens = session.enc.encode(prompt) if prompt else [end_token]
+            items.append((tokens, dict(request, id=request.get('id', line_number), prompt=prompt)))
+        for batch in make_batches(items, args.batch_size, args.max_padding):
+            contexts, padding = pad_batch(batch, end_token)
+            start = time.time()
+            out = session.generate_batch(contexts, args.length)
+            seconds = time.time() - start
+            logging.info('BATCH ' + str(batch_number) + ': ' + str(len(batch)) + ' prompts in ' + str(round(seconds, 2)) + ' seconds.')
+            for (tokens, item), generated in zip(batch, out):
+                sink.write(json.dumps({
+                    'id': item['id'],
+                    'prompt': item['prompt'],
+                    'text': session.enc.decode(generated),
+                    'prompt_tokens': len(tokens),
+                    'tokens': len(generated),
+                    'batch': batch_number,
+                    'batch_size': len(batch),
+                    'padding': padding,
+                    # The rows of a batch are generated together, each gets an equal share.
+                    'seconds': seconds / len(batch),
+                    'batch_seconds': seconds,
+                }, ensure_ascii=False) + '\n')
+            sink.flush()
+            batch_number += 1
+    session.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+import os
+import json
+import logging
+
+BOT_CONFIG_PATH = os.path.join('config', 'bot.json')
+
+def default_bot_config():
+    return {
+    # Inference servers (see inference_server.py) to generate on. Empty means generate in this process.
+    'backends': [],
+    # Seconds a generation may run before it is stopped and what it has so far is sent.
+    'generation_deadline': 300,
+    # Unconditional samples kept ready per sampling configuration, 0 turns pregeneration off.
+    # Not used with backends, remote generations can't be stopped for a user's request.
+    'pregen_pool_size': 2,
+    # Seconds without generations before the pool is refilled.
+    'pregen_idle_seconds': 10,
+    # Channel messages looked at and prompt tokens spent on history in chat mode.
+    'chat_history_messages': 50,
+    'chat_history_tokens': 512,
+    # Guild sessions loaded at the same time on startup.
+    'startup_workers': 4,
+    # Settings for every model, overridden per model name under 'models'.
+    'model_defaults': {
+        # 0 lets tensorflow pick, which is one thread per core for each pool.
+        'intra_op_threads': 0,
+        'inter_op_threads': 0,
+        # Run all sessions of a model on one inter-op pool, e.g. the old and new one across a reload.
+        'share_thread_pool': True,
+        # Generations of a model that may run at once.
+        'executor_workers': 1,
+        # Graph optimizer level, 'L1' or 'L0'.
+        'opt_level': 'L1',
+        # Compile the graph with XLA.
+        'jit': False,
+        # Memory for the chat mode KV caches of all guilds on the model, least recently used channels go first.
+        'kv_cache_bytes': 1 << 30,
+        # Storage type of attention keys/values: 'float32', 'float16' or 'bfloat16'.
+        # Check the quality impact with kv_precision_check.py before switching.
+        'kv_dtype': 'float32',
+    },
+    'models': {},
+    }
+
+def load_bot_config(path=BOT_CONFIG_PATH):
+    """Bot-wide settings from config/bot.json, falling back to the defaults for missing keys."""
+    config = default_bot_config()
+    if os.path.isfile(path):
+        with open(path, 'r') as f:
+            overrides = json.load(f)
+        config['model_defaults'].update(overrides.pop('model_defaults', {}))
+        config.update(overrides)
+    else:
+        logging.info('No bot config at ' + path + ', using defaults.')
+    return config
+
+def model_settings(config, model_name):
+    """The model_defaults with the overrides for model_name applied."""
+    settings = dict(config['model_defaults'])
+    settings.update(config['models'].get(model_name, {}))
+    return settings
@@ -0,0 +1,59 @@
+import time
+import threading
+
+class CancelToken:
+    """Cancellation and an optional deadline for one generation. Sessions watch it while a
+    run is going and stop the sampling loop inside the graph as soon as it fires."""
+
+    def __init__(self, deadline=None):
+        self.deadline = None if deadline is None else time.time() + deadline
+        self.reason = None
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    def cancel(self, reason='cancelled'):
+        with self.lock:
+            if self.reason is not None:
+                return
+            self.reason = reason
+            callbacks = list(self.callbacks)
+        for callback in callbacks:
+            callback()
+
+    def cancelled(self):
+        if self.reason is None and self.deadline is not None and time.time() > self.deadline:
+            self.cancel('deadline')
+        return self.reason is not None
+
+    def aborted(self):
+        """Cancelled for another reason than the deadline, so nobody wants what was generated."""
+        return self.reason is not None and self.reason != 'deadline'
+
+    def remaining(self):
+        """Seconds left until the deadline, None without one."""
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.time(), 0)
+
+    def watch(self, callback):
+        """Call callback, from whichever thread cancels, once the token is cancelled or its
+        deadline passes. Returns a function that stops watching."""
+        with self.lock:
+            fired = self.reason is not None
+            if not fired:
+                self.callbacks.append(callback)
+        if fired:
+            callback()
+        timer = None
+        if self.deadline is not None and not fired:
+            timer = threading.Timer(max(self.deadline - time.time(), 0), self.cancelled)
+            timer.daemon = True
+            timer.start()
+
+        def unwatch():
+            if timer is not None:
+                timer.cancel()
+            with self.lock:
+                if callback in self.callbacks:
+                    self.callbacks.remove(callback)
+        return unwatch
@@ -0,0 +1,69 @@
+import threading
+from collections import OrderedDict
+
+# A chat line is the speaker followed by the content, "name: content\n". They are encoded
+# separately so a nickname change doesn't leave stale names in cached messages.
+def format_speaker(author):
+    return author + ':'
+
+def format_content(content):
+    return ' ' + content + '\n'
+
+class MessageTokenCache:
+    """BPE token ids of the content of every Discord message id, so every message is
+    encoded once.
+
+    All GPT-2 sizes share one encoder, so the ids are valid whichever model a guild uses.
+    Edited and deleted messages have to be invalidated by the caller.
+    """
+
+    def __init__(self, max_messages=20000):
+        self.max_messages = max_messages
+        self.tokens = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, message_id):
+        with self.lock:
+            if message_id not in self.tokens:
+                return None
+            self.tokens.move_to_end(message_id)
+            return self.tokens[message_id]
+
+    def put(self, message_id, tokens):
+        with self.lock:
+            self.tokens[message_id] = tokens
+            self.tokens.move_to_end(message_id)
+            while len(self.tokens) > self.max_messages:
+                self.tokens.popitem(last=False)
+
+    def invalidate(self, message_id):
+        with self.lock:
+            self.tokens.pop(message_id, None)
+
+def encode_all(enc, texts):
+    """Encode (key, text) pairs, meant to run off the event loop."""
+    return [(key, enc.encode(text)) for key, text in texts]
+
+def build_prompt(history, current_tokens, budget, start=None):
+    """Concatenate history messages and current_tokens within budget tokens, returns the
+    prompt and the id of the message it starts at. history is (message id, tokens) pairs,
+    oldest first.
+
+    The prompt keeps starting at start, the message the previous one started at, so it
+    extends the previous prompt and the cached presents can be reused. Only once that no
+    longer fits (or start is gone) does it start over, from the newest messages filling
+    half the budget, so the start moves in big jumps rather than one message every turn.
+    """
+    budget -= len(current_tokens)
+    ids = [message_id for message_id, _ in history]
+    first = ids.index(start) if start in ids else None
+    if first is None or sum(len(tokens) for _, tokens in history[first:]) > budget:
+        first = len(history)
+        used = 0
+        while first > 0 and used + len(history[first - 1][1]) <= budget // 2:
+            first -= 1
+            used += len(history[first][1])
+    prompt = []
+    for _, tokens in history[first:]:
+        prompt.extend(tokens)
+    return prompt + current_tokens, ids[first] if first < len(ids) else None
@@ -1,26 +1,212 @@
 import numpy as np
 import tensorflow as tf
 import logging
+import time
 import copy
 import functools
 import os
 import sys
 import json
+import queue
+import threading
 from src import model, sample, encoder
+from bot_config import default_bot_config, model_settings
+from kv_cache import KVCache, common_prefix
+
+# Encoders and hparams are the same for every guild on a model, load them once per process.
+@functools.lru_cache()
+def load_encoder(model_name):
+    return encoder.get_encoder(model_name)
+
+@functools.lru_cache()
+def load_hparams(model_name):
+    with open(os.path.join('models', model_name, 'hparams.json')) as f:
+        return json.load(f)
+
+def model_hparams(model_name, bot_config):
+    hparams = model.default_hparams()
+    hparams.override_from_dict(load_hparams(model_name))
+    hparams.set_hparam('kv_dtype', model_settings(bot_config, model_name)['kv_dtype'])
+    return hparams
+
+# Runs on one shared model that can be stopped at the same time, each gets its own slot.
+STOP_SLOTS = 64
+
+class SharedModel:
+    """The graph, tensorflow session and restored weights of one model, used by every guild
+    session on that model. Guilds feed their own sampling settings and lengths, and every
+    cancellable run stops through its own slot of the stop vector. There is also one KV
+    cache per model for all guilds, so its budget doesn't grow with the guild count."""
+
+    def __init__(self, model_name, bot_config, seed=42069, prefill_chunk=256):
+        self.model_name = model_name
+        self.bot_config = bot_config
+        # Seconds spent in each phase of loading the model.
+        self.timings = {}
+        self.users = 0
+        start = time.time()
+        self.enc = load_encoder(model_name)
+        self.hparams = model_hparams(model_name, bot_config)
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.set_random_seed(seed)
+        self.session = tf.Session(graph=self.graph, config=self.session_config())
+        self.timings['session'] = time.time() - start
+        start = time.time()
+        with self.graph.as_default():
+            # The batch dimension is left open, batch_size only caps the rows fed at once.
+            self.context = tf.placeholder(tf.int32, [None, None])
+            self.gen_length = tf.placeholder(tf.int32, [], name='gen_length')
+            # Presents of tokens before the context, fed from the KV cache.
+            self.past = tf.placeholder_with_default(
+                tf.zeros(model.past_shape(hparams=self.hparams, batch_size=tf.shape(self.context)[0], sequence=0), dtype=self.hparams.kv_dtype),
+                model.past_shape(hparams=self.hparams), name='past')
+            # Sampling settings are fed rather than built into the graph, so one session can
+            # serve every guild's (see gpt2_server_sessions.run).
+            self.temperature_in = tf.placeholder(tf.float32, [], name='temperature')
+            self.top_k_in = tf.placeholder(tf.int32, [], name='top_k')
+            # A run ends its sampling loop once its slot is set, see gpt2_server_sessions.run.
+            # Slot 0 is never set, for runs that can't be stopped. A local variable, so the
+            # Saver doesn't look for it in the checkpoint.
+            self.stop = tf.get_variable('stop', initializer=tf.zeros([STOP_SLOTS + 1], tf.int32), trainable=False,
+                collections=[tf.GraphKeys.LOCAL_VARIABLES], use_resource=True)
+            self.stop_slot = tf.placeholder_with_default(0, [], name='stop_slot')
+            self.stop_value = tf.placeholder(tf.int32, [], name='stop_value')
+            self.stop_update = tf.scatter_update(self.stop, [self.stop_slot], [self.stop_value])
+            stopped = lambda: tf.not_equal(tf.gather(self.stop.read_value(), self.stop_slot), 0)
+            self.output, self.output_presents = sample.sample_sequence(
+                hparams=self.hparams, length=self.gen_length,
+                #start_token=self.enc.encoder['<|endoftext|>'],
+                context=self.context,
+                batch_size=None,
+                temperature=self.temperature_in, top_k=self.top_k_in,
+                prefill_chunk=prefill_chunk,
+                past=self.past, return_presents=True, stop=stopped
+            )
+            self.uncon_output = sample.sample_sequence(
+                hparams=self.hparams, length=self.gen_length,
+                start_token=int(self.enc.encoder["<|endoftext|>"]),
+                batch_size=1,
+                temperature=self.temperature_in, top_k=self.top_k_in, top_p=0.0,
+                stop=stopped
+            )[:, 1:]
+            self.varloader = tf.train.Saver()
+            self.timings['graph'] = time.time() - start
+            start = time.time()
+            self.ckpt = tf.train.latest_checkpoint(os.path.join('models', model_name))
+            self.varloader.restore(self.session, self.ckpt)
+            self.session.run(self.stop.initializer)
+            self.timings['restore'] = time.time() - start
+        self.slots = queue.Queue()
+        for slot in range(1, STOP_SLOTS + 1):
+            self.slots.put(slot)
+        self.kv_cache = KVCache(model_settings(bot_config, model_name)['kv_cache_bytes'])
+
+    def session_config(self):
+        """ConfigProto for this model from the bot config, see bot_config.model_settings."""
+        settings = model_settings(self.bot_config, self.model_name)
+        config = tf.ConfigProto(
+            intra_op_parallelism_threads=settings['intra_op_threads'],
+            inter_op_parallelism_threads=settings['inter_op_threads'],
+        )
+        if settings['share_thread_pool']:
+            # Sessions of the same model, e.g. the old and new one across a reload, schedule
+            # ops on one named pool instead of each bringing their own set of threads.
+            config.session_inter_op_thread_pool.add(
+                num_threads=settings['inter_op_threads'],
+                global_name='gpt2-' + self.model_name)
+        optimizer_options = config.graph_options.optimizer_options
+        if settings['opt_level'] == 'L0':
+            optimizer_options.opt_level = tf.OptimizerOptions.L0
+        if settings['jit']:
+            optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+        return config
+
+    def set_stop(self, slot, value):
+        self.session.run(self.stop_update, feed_dict={self.stop_slot: slot, self.stop_value: value})
+
+    def close(self):
+        logging.info('Closing ' + self.model_name + ', no guild uses it anymore.')
+        self.kv_cache.clear()
+        self.session.close()
+
+class SharedModels:
+    """The loaded SharedModel of every model in use, counted by the guild sessions using it.
+    A model is loaded by the first session that asks for it, sessions asking meanwhile wait
+    for that instead of loading it again, and it is closed when the last one lets go."""
+
+    def __init__(self):
+        self.models = {}
+        self.loading = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, model_name, bot_config):
+        """Returns the SharedModel and whether this call loaded it. Hand it back with release()."""
+        while True:
+            with self.lock:
+                if model_name in self.models:
+                    shared = self.models[model_name]
+                    shared.users += 1
+                    return shared, False
+                loaded = self.loading.get(model_name)
+                if loaded is None:
+                    loaded = self.loading[model_name] = threading.Event()
+                    break
+            # Another session is loading it, look again once it is done.
+            loaded.wait()
+        try:
+            logging.info('LOADING ' + model_name)
+            shared = SharedModel(model_name, bot_config)
+        finally:
+            with self.lock:
+                del self.loading[model_name]
+            loaded.set()
+        with self.lock:
+            shared.users = 1
+            self.models[model_name] = shared
+        return shared, True
+
+    def release(self, shared):
+        with self.lock:
+            shared.users -= 1
+            if shared.users > 0:
+                return
+            if self.models.get(shared.model_name) is shared:
+                del self.models[shared.model_name]
+        shared.close()
+
+shared_models = SharedModels()
+
+def stored_model_name(server_id):
+    """The model a guild is configured to use, without loading anything."""
+    filename = os.path.join('config', 'servers', str(server_id) + ".json")
+    if os.path.isfile(filename):
+        with open(filename, 'r') as f:
+            return json.load(f)['model_name']
+    return gpt2_server_sessions.default_config()['model_name']
 
 class gpt2_server_sessions:
 
-    def __init__(self,server_id):
+    def __init__(self,server_id,config=None,bot_config=None):
         self.server_id = server_id
+        self.bot_config = default_bot_config() if bot_config is None else bot_config
+        # Set to a list to collect a RunMetadata trace of every session.run, see profiling.py.
+        self.traces = None
+        # Seconds spent in each phase of the last model load, see startup.py.
+        self.timings = {}
+        self.shared = None
         self.conf_path = os.path.join('config', 'servers')
-        self.load_json(server_id)
+        if config is None:
+            self.load_json(server_id)
+        else:
+            self.server_configs = dict(self.default_config(), **config)
         json_conf = self.server_configs
         self.init_state(json_conf['nsamples'],json_conf['length'],json_conf['temperature'],json_conf['top_k'],json_conf['model_name'])
         self.reset_model()
 
-    def init_state(self, nsamples=1, length=200, temperature=1, top_k=0, model_name='1558M'):
+    def init_state(self, nsamples=1, length=200, temperature=1, top_k=0, model_name='1558M', batch_size=1):
         self.model_name = model_name
-        self.batch_size = 1
+        self.batch_size = batch_size
         self.seed = 42069
         self.nsamples = nsamples
         self.length = length
@@ -42,48 +228,47 @@ class gpt2_server_sessions:
 
     def preinit_model(self):
         np.random.seed(self.seed)
-        tf.set_random_seed(self.seed)
-        self.enc = encoder.get_encoder(self.model_name)
-        self.hparams = model.default_hparams()
-        with open(os.path.join('models', self.model_name, 'hparams.json')) as f:
-            self.hparams.override_from_dict(json.load(f))
+        self.enc = load_encoder(self.model_name)
+        self.hparams = model_hparams(self.model_name, self.bot_config)
 
         if self.length is None:
             self.length = self.hparams.n_ctx // 2
         elif self.length > self.hparams.n_ctx:
-            logging.error("Can't get samples longer than window size: %s" % self.hparams.n_ctx)
+            logging.info("Samples longer than window size %s will be generated with a sliding window." % self.hparams.n_ctx)
+        # Tokens of trailing context kept when the window has to slide.
+        self.context_overlap = self.hparams.n_ctx // 2
+
+    def start_session(self):
+        # Every guild on a model uses the same graph and session, see SharedModel.
+        start = time.time()
+        self.shared, loaded = shared_models.acquire(self.model_name, self.bot_config)
+        if loaded:
+            self.timings.update(self.shared.timings)
+        else:
+            self.timings['shared'] = time.time() - start
 
     def init_model(self):
-        self.context = tf.placeholder(tf.int32, [self.batch_size, None])
-        self.output = sample.sample_sequence(
-            hparams=self.hparams, length=self.length,
-            #start_token=self.enc.encoder['<|endoftext|>'],
-            context=self.context,
-            batch_size=self.batch_size,
-            temperature=self.temperature, top_k=self.top_k
-        )
-        self.uncon_output = sample.sample_sequence(
-            hparams=self.hparams, length=self.length,
-            start_token=int(self.enc.encoder["<|endoftext|>"]),
-            batch_size=self.batch_size,
-            temperature=self.temperature, top_k=self.top_k, top_p=0.0
-        )[:, 1:]
-        self.varloader = tf.train.Saver()
-        self.ckpt = tf.train.latest_checkpoint(os.path.join('models', self.model_name))
-        self.varloader.restore(self.session, self.ckpt)
+        self.kv_cache = self.shared.kv_cache
 
     def reset_model(self):
-        self.init_state(self.server_configs['nsamples'],self.server_configs['length'],self.server_configs['temperature'],self.server_configs['top_k'],self.server_configs['model_name'])
+        self.init_state(self.server_configs['nsamples'],self.server_configs['length'],self.server_configs['temperature'],self.server_configs['top_k'],self.server_configs['model_name'],self.server_configs.get('batch_size', 1))
+        self.timings = {}
+        start = time.time()
         self.preinit_model()
+        self.timings['preinit'] = time.time() - start
         #self.shutdown()
-        self.session = tf.Session()#graph=tf.Graph()) #Interactive?
+        self.start_session()
         #tf.set_random_seed(self.seed)
         #self.uncon_session = tf.Session(graph=tf.Graph())
         self.init_model()
 
     def shutdown(self):
         logging.info('Shutting down GPT.')
-        self.session.close()
+        if self.shared is None:
+            return
+        self.kv_cache.pop_guild(self.server_id)
+        shared, self.shared = self.shared, None
+        shared_models.release(shared)
         #self.uncon_session.close()
 
     def writeConfig(self,server_id):
@@ -97,17 +282,180 @@ class gpt2_server_sessions:
         else:
             self.server_configs = self.default_config()
 
-    def default_config(self):
+    @staticmethod
+    def default_config():
         return {
         'model_name':'1558M',
         'nsamples':1,
         'length':200,
         'temperature':1,
-        'top_k':40
+        'top_k':40,
+        'chat_mode':False
         }
-    def generate_text(self, context_tokens):
-        return self.session.run(self.output, feed_dict={
-                    self.context: [context_tokens for _ in range(1)]
-                })[:, len(context_tokens):]
-    def generate_uncon_text(self):
-        return self.session.run(self.uncon_output)
+    def run(self, fetches, feed_dict=None, sampling=None, cancel=None):
+        """session.run on the shared model with this guild's sampling settings, or sampling
+        ({'temperature', 'top_k'}) instead. With a cancel token (see cancellation.py) the
+        sampling loop ends at the next token once it fires, and what was sampled until then
+        is returned."""
+        shared = self.shared
+        if sampling is None:
+            sampling = {'temperature': self.temperature, 'top_k': self.top_k}
+        feed_dict = dict(feed_dict or {})
+        feed_dict[shared.temperature_in] = float(sampling['temperature'])
+        feed_dict[shared.top_k_in] = int(sampling['top_k'])
+        if cancel is None:
+            return self.traced_run(shared, fetches, feed_dict)
+        # Other guilds' runs go on on the same session, this one gets a stop slot of its own.
+        slot = shared.slots.get()
+        lock = threading.Lock()
+        running = True
+
+        def request_stop():
+            # Holding the lock, so the slot can't be handed to the next run under a late stop.
+            with lock:
+                if not running:
+                    return
+                try:
+                    shared.set_stop(slot, 1)
+                except RuntimeError as e:
+                    # The session was closed under the run, which ends it anyway.
+                    logging.info('Could not stop generation: ' + str(e))
+
+        try:
+            shared.set_stop(slot, 0)
+            feed_dict[shared.stop_slot] = slot
+            unwatch = cancel.watch(request_stop)
+            try:
+                return self.traced_run(shared, fetches, feed_dict)
+            finally:
+                unwatch()
+        finally:
+            with lock:
+                running = False
+            shared.slots.put(slot)
+
+    def traced_run(self, shared, fetches, feed_dict=None):
+        if self.traces is None:
+            return shared.session.run(fetches, feed_dict=feed_dict)
+        run_metadata = tf.RunMetadata()
+        out = shared.session.run(fetches, feed_dict=feed_dict,
+            options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), run_metadata=run_metadata)
+        self.traces.append(run_metadata)
+        return out
+
+    def next_window(self, tokens, remaining):
+        """Pick the context slice and step length of the next run so both fit in n_ctx."""
+        n_ctx = self.hparams.n_ctx
+        step = min(remaining, n_ctx - min(len(tokens), self.context_overlap))
+        return tokens[-(n_ctx - step):], step
+
+    def iter_text(self, tokens, length, max_step=None, sampling=None, cancel=None):
+        """Yield generated tokens run by run until length tokens follow tokens, re-prefilling
+        a trailing slice whenever the window is full. max_step caps the tokens per run.
+        Stops early once cancel fires."""
+        tokens = list(tokens)
+        remaining = length
+        while remaining > 0:
+            if cancel is not None and cancel.cancelled():
+                logging.info('GENERATION STOPPED (' + cancel.reason + ') with ' + str(remaining) + ' tokens to go.')
+                break
+            window, step = self.next_window(tokens, remaining if max_step is None else min(remaining, max_step))
+            out = self.run(self.shared.output, feed_dict={
+                        self.shared.context: [window for _ in range(1)],
+                        self.shared.gen_length: step
+                    }, sampling=sampling, cancel=cancel)[:, len(window):]
+            tokens.extend(out[0])
+            remaining -= step
+            yield list(out[0])
+
+    def continue_text(self, tokens, length, sampling=None, cancel=None):
+        generated = []
+        for out in self.iter_text(tokens, length, sampling=sampling, cancel=cancel):
+            generated.extend(out)
+        return generated
+
+    def generate_text(self, context_tokens, length=None, cache_key=None, cancel=None, sampling=None):
+        length = self.length if length is None else length
+        if cache_key is not None:
+            return np.array([self.generate_cached(context_tokens, length, cache_key, cancel, sampling)])
+        return np.array([self.continue_text(context_tokens, length, sampling, cancel)])
+
+    def run_segment(self, tokens, length, history=None, presents=None, sampling=None, cancel=None):
+        """One run generating length tokens after tokens, feeding the presents of the part
+        of tokens they share with history instead of prefilling it again.
+        Returns the generated tokens and the new history and presents, which cover
+        everything fed to the model: all but the last generated token."""
+        feed_dict = {self.shared.gen_length: length}
+        reuse = 0
+        if presents is not None:
+            # The last context token is always fed, sampling starts from its logits.
+            reuse = min(common_prefix(history, tokens), len(tokens) - 1)
+            if reuse > 0:
+                feed_dict[self.shared.past] = presents[..., :reuse, :]
+        feed_dict[self.shared.context] = [tokens[reuse:]]
+        out, presents = self.run([self.shared.output, self.shared.output_presents], feed_dict=feed_dict, sampling=sampling, cancel=cancel)
+        generated = list(out[0, len(tokens) - reuse:])
+        return generated, (tokens + generated)[:-1], presents, reuse
+
+    def generate_cached(self, context_tokens, length, cache_key, cancel=None, sampling=None):
+        """Generate after context_tokens reusing the presents this guild cached for cache_key,
+        then cache the new ones. Only this path fetches the presents out of the graph."""
+        tokens = list(context_tokens)
+        generated = []
+        cache_key = (self.server_id, cache_key)
+        history, presents = self.kv_cache.get(cache_key) or (None, None)
+        first = True
+        slid = False
+        while len(generated) < length:
+            if cancel is not None and cancel.cancelled():
+                logging.info('GENERATION STOPPED (' + cancel.reason + ') after ' + str(len(generated)) + ' tokens.')
+                break
+            step = length - len(generated)
+            if len(tokens) + step > self.hparams.n_ctx:
+                # Slide the window, positions shift so the presents can't be reused.
+                window, _ = self.next_window(tokens, step)
+                tokens = list(window)
+                step = min(step, self.hparams.n_ctx - len(tokens))
+                history = presents = None
+                slid = True
+            out, history, presents, reuse = self.run_segment(tokens, step, history, presents, sampling, cancel)
+            if first:
+                logging.info('KV CACHE: reused ' + str(reuse) + ' of ' + str(len(tokens)) + ' context tokens, '
+                    + self.kv_cache.record(reuse, len(tokens)) + '.')
+                first = False
+            generated.extend(out)
+            tokens.extend(out)
+        if slid or presents is None:
+            self.kv_cache.pop(cache_key)
+        else:
+            self.kv_cache.put(cache_key, history, presents)
+        return generated
+
+    def forget_channel(self, channel_id):
+        self.kv_cache.pop((self.server_id, channel_id))
+
+    def generate_batch(self, contexts, length=None):
+        """Generate after up to batch_size contexts of equal length at once, returns
+        [len(contexts), length] tokens."""
+        rows = [list(context) for context in contexts]
+        generated = [[] for _ in rows]
+        remaining = self.length if length is None else length
+        while remaining > 0:
+            window, step = self.next_window(rows[0], remaining)
+            out = self.run(self.shared.output, feed_dict={
+                        self.shared.context: [row[-len(window):] for row in rows],
+                        self.shared.gen_length: step
+                    })[:, len(window):]
+            for row, tokens, new in zip(rows, generated, out):
+                row.extend(new)
+                tokens.extend(new)
+            remaining -= step
+        return np.array(generated)
+
+    def generate_uncon_text(self, length=None, cancel=None, sampling=None):
+        length = self.length if length is None else length
+        step = min(length, self.hparams.n_ctx - 1)
+        out = self.run(self.shared.uncon_output, feed_dict={self.shared.gen_length: step}, sampling=sampling, cancel=cancel)
+        if step < length:
+            return np.array([list(out[0]) + self.continue_text(out[0], length - step, sampling, cancel)])
+        return out
@@ -4,11 +4,23 @@ import os
 import sys
 import json
 import time
+import asyncio
 import discord
 import threading
 import logging
 import functools
+import cProfile
+import profiling
 from gpt2_server_sessions import gpt2_server_sessions
+from inference_client import InferenceBackends, remote_server_sessions
+from bot_config import load_bot_config, model_settings
+from concurrent.futures import ThreadPoolExecutor
+from admission import AdmissionControl
+from output_sender import OutputSender
+from cancellation import CancelToken
+from pregen_pool import PregenPool
+from chat_history import MessageTokenCache, format_speaker, format_content, encode_all, build_prompt
+from startup import StartupPipeline
 from datetime import datetime, timedelta
 from discord.ext import commands
 from discord import utils
@@ -24,70 +36,286 @@ class GPT2Bot(commands.Cog):
 
         self.bot = bot
         self.not_ready_s = "Bot has not been initialized. Please type !init to initialize the bot."
+        self.loading_s = "GPT-2 is still loading for this server. Please try again in a moment."
+        self.failed_s = "GPT-2 failed to load for this server ({}). Type !init to try again."
         self.is_interfering = True
         self.not_ready = True
-        self.sizeLimit=1000 # NOTE: Set this according to your own machine.
+        self.admission = AdmissionControl(max_request_seconds=120) # NOTE: Set this according to your own machine.
+        self.sender = OutputSender(bot.loop)
         self.guildIdList = []
         self.serverSessions = {}
+        # Guild id to the error its session failed to load with, until it is retried.
+        self.failed_guilds = {}
         self.is_interfering = False
+        self.config = load_bot_config()
+        self.executors = {}
+        # Message id of every running generation to its (cancel token, channel id, guild id).
+        self.generations = {}
+        self.last_activity = time.time()
+        self.pregen = PregenPool(self.config['pregen_pool_size'])
+        self.pregen_cancel = None
+        self.pregen_run = None
+        self.token_cache = MessageTokenCache()
+        # Channel id to the message its last chat prompt started at, see build_prompt.
+        self.chat_starts = {}
+        # Remote generations can't be stopped, a pregeneration would hold up the user's request.
+        if self.config['pregen_pool_size'] > 0 and not self.config['backends']:
+            self.bot.loop.create_task(self.refill_pregen())
+        if self.config['backends']:
+            logging.info('Generating on backends: ' + ', '.join(self.config['backends']))
+            self.backends = InferenceBackends(self.config['backends'])
+            self.session_factory = functools.partial(remote_server_sessions, backends=self.backends, bot_config=self.config)
+        else:
+            self.session_factory = functools.partial(gpt2_server_sessions, bot_config=self.config)
+        self.loader = StartupPipeline(bot.loop, lambda guild_id: self.session_factory(guild_id),
+            self.guild_loaded, self.guild_failed, self.config['startup_workers'])
         self.models = os.listdir(os.path.join('models'))
 
     @commands.command()
     async def init(self, ctx):
+        await ctx.send("Loading GPT-2...")
+        await self.load_guilds()
+        await ctx.send("GPT-2 AI initialized")
+
+    async def load_guilds(self):
+        """Load a session for every guild the bot is in that doesn't have one yet."""
         guilds = await self.bot.fetch_guilds(limit=150).flatten()
         for guild in guilds:
-            self.guildIdList.append(guild.id)
-        self.serverSessions = {}
-        for serverid in self.guildIdList:
-            self.serverSessions[serverid] = gpt2_server_sessions(serverid)
-        await ctx.send("GPT-2 AI initialized")
+            if guild.id not in self.guildIdList:
+                self.guildIdList.append(guild.id)
+        # Commands can be used from here on, guilds whose model isn't loaded yet are told so by check_ready.
         self.not_ready = False
+        await self.load_sessions([serverid for serverid in self.guildIdList if serverid not in self.serverSessions])
+
+    async def load_sessions(self, guild_ids):
+        for guild_id in guild_ids:
+            # Failed guilds are retried, they show as loading again meanwhile.
+            self.failed_guilds.pop(guild_id, None)
+        await self.loader.load(guild_ids)
+
+    def guild_loaded(self, guild_id, session):
+        if guild_id not in self.guildIdList:
+            logging.info('Guild ' + str(guild_id) + ' was removed while loading, dropping its session.')
+            session.shutdown()
+            return
+        self.serverSessions[guild_id] = session
+
+    def guild_failed(self, guild_id, error):
+        if guild_id in self.guildIdList:
+            self.failed_guilds[guild_id] = str(error)
+
+    async def check_ready(self, ctx):
+        if self.not_ready:
+            await ctx.send(self.not_ready_s)
+            return False
+        if ctx.message.guild is not None and ctx.message.guild.id in self.failed_guilds:
+            await ctx.send(self.failed_s.format(self.failed_guilds[ctx.message.guild.id]))
+            return False
+        if ctx.message.guild is not None and ctx.message.guild.id not in self.serverSessions:
+            await ctx.send(self.loading_s)
+            return False
+        return True
 
     @commands.command()
     @commands.guild_only()
     async def talk(self, ctx, *, message):
         logging.info('MSG: ' + message)
         if (self.is_interfering):
-            await ctx.send('Currently talking to someone. Try again later.')
+            await ctx.send(self.busy_text())
             return
-        if (self.not_ready):
-            await ctx.send(self.not_ready_s)
+        if not await self.check_ready(ctx):
             return
         server_id = ctx.message.guild.id
+        # The guild can remove the bot while this awaits, which pops its session.
+        session = self.serverSessions[server_id]
         logging.info('Guild: ' + str(server_id))
         self.is_interfering = True
-        if message:
-            context_tokens = self.serverSessions[server_id].enc.encode(message)
-        for _ in range(self.serverSessions[server_id].nsamples):
-            async with ctx.typing():
-                start = time.time()
-                if message:
-                    text_generator = functools.partial(self.generate_text, server_id, context_tokens)
-                    out = await self.bot.loop.run_in_executor(None, text_generator)
-                else:
-                    text_generator = functools.partial(self.generate_uncon_text, server_id)
-                    out = await self.bot.loop.run_in_executor(None, text_generator)
-                response = message + self.serverSessions[server_id].enc.decode(out[0])
-                logging.info('RESPONSE GENERATED IN :' + str(round(time.time() - start, 2)) + ' seconds.')
-                logging.info('RESPONSE: ' + response)
-                logging.info('RESPONSE LEN: ' + str(len(response)))
-
-                response_chunk = 0
-                chunk_size = 1990
-                if (len(response) > 2000):
-                    while (len(response) > response_chunk):
-                        await ctx.send(response[response_chunk:response_chunk + chunk_size])
-                        response_chunk += chunk_size
-                else:
-                    await ctx.send(response)
+        job = None
+        cancel = self.start_generation(ctx)
+        try:
+            prompt_tokens = 0
+            if message:
+                context_tokens, cache_key = await self.talk_prompt(ctx, session, message)
+                prompt_tokens = len(context_tokens)
+            job = await self.admit(ctx, session, prompt_tokens)
+            for _ in range(session.nsamples):
+                if cancel.cancelled():
+                    break
+                async with ctx.typing():
+                    start = time.time()
+                    if message:
+                        text_generator = functools.partial(session.generate_text, context_tokens, cache_key=cache_key, cancel=cancel)
+                        out = await self.bot.loop.run_in_executor(self.executor_for(session), text_generator)
+                    else:
+                        text_generator = functools.partial(session.generate_uncon_text, cancel=cancel)
+                        out = await self.bot.loop.run_in_executor(self.executor_for(session), text_generator)
+                    self.admission.record(session.model_name, len(out[0]), time.time() - start, prompt_tokens)
+                    response = self.talk_response(session, message, out[0])
+                    logging.info('RESPONSE GENERATED IN :' + str(round(time.time() - start, 2)) + ' seconds.')
+                    logging.info('RESPONSE: ' + response)
+                    logging.info('RESPONSE LEN: ' + str(len(response)))
+                    response = self.cut_short(response, cancel)
+                    if response is None:
+                        break
+                    self.sender.send(ctx.channel, response, reply=True)
+        except Exception as e:
+            self.stopped_error(cancel, e)
+        finally:
+            self.end_generation(ctx, job)
 
+    def start_generation(self, ctx):
+        # Users go first, a pregeneration in progress is thrown away.
+        self.cancel_pregen()
+        cancel = CancelToken(self.config['generation_deadline'])
+        self.generations[ctx.message.id] = (cancel, ctx.channel.id, ctx.message.guild.id)
+        return cancel
+
+    def end_generation(self, ctx, job=None):
+        self.last_activity = time.time()
+        self.generations.pop(ctx.message.id, None)
+        if job is not None:
+            self.admission.finish(job)
         self.is_interfering = False
 
-    def generate_text(self, server_id, context_tokens):
-        return self.serverSessions[server_id].generate_text(context_tokens)
+    def stopped_error(self, cancel, error):
+        """Re-raise an error from a generation, unless it was stopped on purpose, e.g. its
+        session was shut down as the guild removed the bot."""
+        if not cancel.aborted():
+            raise error
+        logging.info('GENERATION STOPPED (' + cancel.reason + '): ' + str(error))
+
+    def cancel_pregen(self):
+        self.last_activity = time.time()
+        if self.pregen_cancel is not None:
+            self.pregen_cancel.cancel('preempted')
+
+    async def stop_pregen(self):
+        """Cancel a pregeneration in progress and wait for it to end, for commands that
+        reconfigure or shut down a session."""
+        self.cancel_pregen()
+        if self.pregen_run is not None:
+            await asyncio.wait([self.pregen_run])
 
-    def generate_uncon_text(self, server_id):
-        return self.serverSessions[server_id].generate_uncon_text()
+    async def refill_pregen(self):
+        """Top up the pregenerated unconditional samples while no one is waiting on a generation."""
+        while True:
+            await asyncio.sleep(1)
+            if self.not_ready or self.is_interfering or self.generations:
+                continue
+            if time.time() - self.last_activity < self.config['pregen_idle_seconds']:
+                continue
+            sessions = list(self.serverSessions.values())
+            self.pregen.prune(sessions)
+            session = self.pregen.wanted(sessions)
+            if session is None:
+                continue
+            key = self.pregen.key(session)
+            cancel = self.pregen_cancel = CancelToken()
+            try:
+                text_generator = functools.partial(session.generate_uncon_text, cancel=cancel)
+                self.pregen_run = self.bot.loop.run_in_executor(self.executor_for(session), text_generator)
+                out = await self.pregen_run
+            except Exception as e:
+                logging.error('Pregeneration failed: ' + str(e))
+                await asyncio.sleep(self.config['pregen_idle_seconds'])
+                continue
+            finally:
+                self.pregen_cancel = None
+                self.pregen_run = None
+            if cancel.reason is None and self.pregen.key(session) == key:
+                self.pregen.put(key, out[0])
+                logging.info('PREGENERATED SAMPLE FOR ' + str(key))
+
+    def cancel_generations(self, reason, channel_id=None, guild_id=None):
+        for cancel, generation_channel, generation_guild in self.generations.values():
+            if generation_channel == channel_id or generation_guild == guild_id:
+                cancel.cancel(reason)
+
+    def cut_short(self, response, cancel):
+        """The response to send for a generation that may have been stopped early, None if
+        there is nobody left to send it to."""
+        if not cancel.cancelled():
+            return response
+        logging.info('GENERATION STOPPED: ' + cancel.reason)
+        if cancel.aborted():
+            return None
+        return response + ' [...]\n*(Stopped after ' + str(self.config['generation_deadline']) + ' seconds.)*'
+
+    def history_text(self, message):
+        """The content of a channel message in a chat prompt, None for messages to leave out."""
+        # The bot's own messages are only part of the conversation when they are generated
+        # replies, not its status, timing and configuration output.
+        if message.author.id == self.bot.user.id and not self.sender.is_reply(message.id):
+            return None
+        content = message.clean_content
+        if content.startswith('!talk'):
+            content = content[len('!talk'):].strip()
+        elif content.startswith('!'):
+            return None
+        if not content:
+            return None
+        return content
+
+    async def chat_prompt(self, ctx, session, message):
+        """Tokens of the recent channel history, the message and the bot's name, within
+        chat_history_tokens. Content token ids are cached per message id, speaker names are
+        encoded every time as they can change. Encoding happens off the event loop."""
+        enc = session.enc
+        history = await ctx.channel.history(limit=self.config['chat_history_messages'], before=ctx.message).flatten()
+        # (message id, speaker, content), newest first and the message itself last.
+        lines = [(m.id, m.author.display_name, self.history_text(m)) for m in history]
+        lines = [line for line in lines if line[2] is not None]
+        lines.append((ctx.message.id, ctx.message.author.display_name, message))
+        # Taken before the await, an edit or delete meanwhile invalidates the cached tokens.
+        cached = {message_id: self.token_cache.get(message_id) for message_id, _, _ in lines}
+        missing = [(message_id, format_content(content)) for message_id, _, content in lines if cached[message_id] is None]
+        names = set(name for _, name, _ in lines) | {self.bot.user.display_name}
+        speakers = [(name, format_speaker(name)) for name in names]
+        encoded, speaker_tokens = await self.bot.loop.run_in_executor(None, lambda: (encode_all(enc, missing), dict(encode_all(enc, speakers))))
+        for message_id, tokens in encoded:
+            self.token_cache.put(message_id, tokens)
+            cached[message_id] = tokens
+        tokens = [(message_id, speaker_tokens[name] + cached[message_id]) for message_id, name, _ in lines]
+        current_tokens = tokens.pop()[1] + speaker_tokens[self.bot.user.display_name]
+        prompt, start = build_prompt(tokens[::-1], current_tokens, self.config['chat_history_tokens'], self.chat_starts.get(ctx.channel.id))
+        self.chat_starts[ctx.channel.id] = start
+        logging.info('CHAT PROMPT FROM ' + str(len(tokens)) + ' MESSAGES, ' + str(len(missing)) + ' ENCODED, ' + str(len(prompt)) + ' TOKENS.')
+        return prompt
+
+    async def talk_prompt(self, ctx, session, message):
+        """Context tokens and KV cache key for a !talk with a message. Only chat prompts,
+        which grow from the channel history, are likely to extend the cached one."""
+        if session.server_configs.get('chat_mode', False):
+            return await self.chat_prompt(ctx, session, message), ctx.channel.id
+        return session.enc.encode(message), None
+
+    def talk_response(self, session, message, tokens):
+        text = session.enc.decode(tokens)
+        if session.server_configs.get('chat_mode', False):
+            return self.chat_reply(text)
+        return message + text
+
+    def chat_reply(self, text):
+        # The model goes on to write the next speakers' lines too, only the bot's own is sent.
+        return text.strip().split('\n')[0].strip() or text.strip()
+
+    def busy_text(self):
+        return 'Currently talking to someone. Try again in about ' + str(round(self.admission.queue_seconds())) + ' seconds.'
+
+    async def admit(self, ctx, session, prompt_tokens):
+        estimate = self.admission.estimate(session.model_name, session.nsamples, session.length, prompt_tokens)
+        logging.info('ESTIMATED: ' + str(round(estimate, 2)) + ' seconds.')
+        if estimate > self.admission.warn_seconds:
+            await ctx.send('Generating, this should take about ' + str(round(estimate)) + ' seconds.')
+        return self.admission.start(estimate)
+
+    def executor_for(self, session):
+        """The bounded executor generations for this session's model run on."""
+        model_name = session.model_name
+        if model_name not in self.executors:
+            workers = model_settings(self.config, model_name)['executor_workers']
+            self.executors[model_name] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='gpt2-' + model_name)
+        return self.executors[model_name]
 
     @commands.command()
     @commands.guild_only()
@@ -95,61 +323,111 @@ class GPT2Bot(commands.Cog):
     async def debugtalk(self, ctx, *, message):
         logging.info('MSG: ' + message)
         if (self.is_interfering):
-            await ctx.send('Currently talking to someone. Try again later.')
+            await ctx.send(self.busy_text())
             return
-        if (self.not_ready):
-            await ctx.send(self.not_ready_s)
-            await ctx.send("Bot isn't ready yet.")
+        if not await self.check_ready(ctx):
             return
         server_id = ctx.message.guild.id
-        await ctx.send('```Guild: ' + str(server_id) + '\n'
-            'Message received, generating response...```')
+        session = self.serverSessions[server_id]
         logging.info('Guild: ' + str(server_id))
         self.is_interfering = True
-        if message:
-            context_tokens = self.serverSessions[server_id].enc.encode(message)
-        for _ in range(self.serverSessions[server_id].nsamples):
-            async with ctx.typing():
-                start = time.time()
-                if message:
-                    text_generator = functools.partial(self.generate_text, server_id, context_tokens)
-                    out = await self.bot.loop.run_in_executor(None, text_generator)
-                else:
-                    text_generator = functools.partial(self.generate_uncon_text, server_id)
-                    out = await self.bot.loop.run_in_executor(None, text_generator)
-                response = message + self.serverSessions[server_id].enc.decode(out[0])
-                logging.info('RESPONSE GENERATED IN:' + str(round(time.time() - start, 2)) + ' SECONDS')
-                logging.info('RESPONSE: ' + response)
-                logging.info('RESPONSE LEN: ' + str(len(response)))
-
-
-                response_chunk = 0
-                chunk_size = 1990
-                if (len(response) > 2000):
-                    while (len(response) > response_chunk):
-                        await ctx.send(response[response_chunk:response_chunk + chunk_size])
-                        response_chunk += chunk_size
-                        await ctx.send('```Response generated in: ' + str(round(time.time() - start, 2)) + ' seconds.\n'
-                            'Response length: ' + str(len(response)) + '```')
-                else:
-                    await ctx.send(response)
-                    await ctx.send('```Response generated in: ' + str(round(time.time() - start, 2)) + ' seconds.\n'
+        job = None
+        cancel = self.start_generation(ctx)
+        try:
+            await ctx.send('```Guild: ' + str(server_id) + '\n'
+                'Message received, generating response...```')
+            prompt_tokens = 0
+            if message:
+                context_tokens = session.enc.encode(message)
+                prompt_tokens = len(context_tokens)
+            job = await self.admit(ctx, session, prompt_tokens)
+            for _ in range(session.nsamples):
+                if cancel.cancelled():
+                    break
+                async with ctx.typing():
+                    start = time.time()
+                    if message:
+                        text_generator = functools.partial(session.generate_text, context_tokens, cancel=cancel)
+                        out = await self.bot.loop.run_in_executor(self.executor_for(session), text_generator)
+                    else:
+                        text_generator = functools.partial(session.generate_uncon_text, cancel=cancel)
+                        out = await self.bot.loop.run_in_executor(self.executor_for(session), text_generator)
+                    self.admission.record(session.model_name, len(out[0]), time.time() - start, prompt_tokens)
+                    response = message + session.enc.decode(out[0])
+                    logging.info('RESPONSE GENERATED IN:' + str(round(time.time() - start, 2)) + ' SECONDS')
+                    logging.info('RESPONSE: ' + response)
+                    logging.info('RESPONSE LEN: ' + str(len(response)))
+                    response = self.cut_short(response, cancel)
+                    if response is None:
+                        break
+                    self.sender.send(ctx.channel, response, reply=True)
+                    self.sender.send(ctx.channel, '```Response generated in: ' + str(round(time.time() - start, 2)) + ' seconds.\n'
                         'Response length: ' + str(len(response)) + '```')
+        except Exception as e:
+            self.stopped_error(cancel, e)
+        finally:
+            self.end_generation(ctx, job)
 
-        self.is_interfering = False
-
-    def generate_text(self, server_id, context_tokens):
-        return self.serverSessions[server_id].generate_text(context_tokens)
-
-    def generate_uncon_text(self, server_id):
-        return self.serverSessions[server_id].generate_uncon_text()
+    @commands.command()
+    @commands.guild_only()
+    @commands.has_permissions(administrator=True)
+    async def profiletalk(self, ctx, *, message):
+        logging.info('PROFILE MSG: ' + message)
+        if (self.is_interfering):
+            await ctx.send(self.busy_text())
+            return
+        if not await self.check_ready(ctx):
+            return
+        server_id = ctx.message.guild.id
+        session = self.serverSessions[server_id]
+        if isinstance(session, remote_server_sessions):
+            await ctx.send('Profiling is only available when generating in the bot process.')
+            return
+        # '!profiletalk --python <message>' also profiles the python side with cProfile.
+        profiler = None
+        if message.startswith('--python '):
+            message = message[len('--python '):]
+            profiler = cProfile.Profile()
+        self.is_interfering = True
+        cancel = self.start_generation(ctx)
+        try:
+            await ctx.send('```Guild: ' + str(server_id) + '\n'
+                'Profiling one generation...```')
+            # A pregeneration on this session would be traced along with the profiled run.
+            await self.stop_pregen()
+            if profiler:
+                profiler.enable()
+            start = time.time()
+            session.traces = []
+            # Profile what !talk does: the same prompt, cache key and cancellable generation,
+            # and wait for the response to be sent so the send path is part of it.
+            try:
+                async with ctx.typing():
+                    context_tokens, cache_key = await self.talk_prompt(ctx, session, message)
+                    text_generator = functools.partial(session.generate_text, context_tokens, cache_key=cache_key, cancel=cancel)
+                    out = await self.bot.loop.run_in_executor(self.executor_for(session), text_generator)
+                    response = self.cut_short(self.talk_response(session, message, out[0]), cancel)
+                    if response is not None:
+                        self.sender.send(ctx.channel, response, reply=True)
+                        await self.sender.flush(ctx.channel)
+            finally:
+                traces = session.traces
+                session.traces = None
+                if profiler:
+                    profiler.disable()
+            seconds = time.time() - start
+            path = profiling.profile_dir(server_id)
+            summary = await self.bot.loop.run_in_executor(None, functools.partial(profiling.save, path, traces, profiler, 40))
+        finally:
+            self.end_generation(ctx)
+        self.sender.send(ctx.channel, '```Response generated and sent in: ' + str(round(seconds, 2)) + ' seconds.\n'
+            'Profile written to: ' + path + '\n\n' + '\n'.join(summary.split('\n')[:12]) + '```')
 
     @commands.command()
     @commands.guild_only()
     @commands.has_permissions(manage_messages=True)
     async def getconfig(self, ctx):
-        if (self.not_ready):
-            await ctx.send(self.not_ready_s)
+        if not await self.check_ready(ctx):
             return
         logging.info('CURRENT STATE.')
         server_id = ctx.message.guild.id
@@ -158,14 +436,37 @@ class GPT2Bot(commands.Cog):
             'Max Length: ' + str(self.serverSessions[server_id].length) + "\n"
             'Temperature: ' + str(self.serverSessions[server_id].temperature) + "\n"
             'Top K: ' + str(self.serverSessions[server_id].top_k) + "\n"
-            'Model: ' + str(self.serverSessions[server_id].model_name) + "```")
+            'Model: ' + str(self.serverSessions[server_id].model_name) + "\n"
+            'Chat mode: ' + ('on' if self.serverSessions[server_id].server_configs.get('chat_mode', False) else 'off') + "```")
+        if self.config['backends']:
+            status = await self.bot.loop.run_in_executor(None, self.backends.health)
+            await ctx.send('**Backends:**\n```' + '\n'.join(
+                url + ': ' + health.get('status', 'unknown') + (', loaded ' + ', '.join(health['loaded']) if health.get('loaded') else '')
+                for url, health in status.items()) + '```')
+
+    @commands.command()
+    @commands.guild_only()
+    @commands.has_permissions(manage_messages=True)
+    async def chatmode(self, ctx, state: str):
+        if not await self.check_ready(ctx):
+            return
+        if state not in ('on', 'off'):
+            await ctx.send('Use `!chatmode on` or `!chatmode off`.')
+            return
+        logging.info('CHAT MODE ' + state.upper() + '.')
+        server_id = ctx.message.guild.id
+        self.serverSessions[server_id].server_configs['chat_mode'] = state == 'on'
+        self.serverSessions[server_id].writeConfig(server_id)
+        if state == 'on':
+            await ctx.send('Chat mode is on, `!talk` will reply to the recent conversation in the channel.')
+        else:
+            await ctx.send('Chat mode is off, `!talk` will continue your message.')
 
     @commands.command()
     @commands.guild_only()
     @commands.has_permissions(manage_messages=True)
     async def helpconfig(self, ctx):
-        if (self.not_ready):
-            await ctx.send(self.not_ready_s)
+        if not await self.check_ready(ctx):
             return
         logging.info('HELP INVOKED.')
         await ctx.send('Configure the bot session by typing: `!setconfig <nsamples> <length> <temperature> <topk> <model>`.\n'
@@ -178,23 +479,21 @@ class GPT2Bot(commands.Cog):
             '0 is a special setting meaning no restrictions. 40 generally is a good value.\n'
             '`model` = Set which model is used for generating text. The larger the model, the longer it will take to generate\n'
             'available models are `117M`, `345M`, `774M` or `1558M`\n'
-            'Get current state by `!getconfig`.')
+            'Get current state by `!getconfig`.\n'
+            'Turn chat mode on or off with `!chatmode on|off`. In chat mode `!talk` replies to the recent messages in the channel.')
 
     @commands.command()
     @commands.guild_only()
     @commands.has_permissions(manage_messages=True)
     async def setconfig(self, ctx, nsamples: int, length: int, temp: float, top_k: int, model_name: str):
-        if (self.not_ready):
-            await ctx.send(self.not_ready_s)
+        if not await self.check_ready(ctx):
             return
         logging.info('SET CONFIGURATION.')
         if (self.is_interfering):
-            await ctx.send('Currently talking to someone. Try again later.')
+            await ctx.send(self.busy_text())
             logging.info('BOT BUSY.')
             return
-        if (self.not_ready):
-            await ctx.send(self.not_ready_s)
-            logging.info('NOT READY.')
+        if not await self.check_ready(ctx):
             return
         if model_name not in self.models:
             await ctx.send('Model ' + model_name + ' does not exist. Please choose a different model!')
@@ -204,8 +503,10 @@ class GPT2Bot(commands.Cog):
 
         await ctx.trigger_typing()
         logging.info('CHECKING SIZE IS OK.')
-        if int(nsamples) * int(length) <= sizeLimit:
+        accepted, estimate = self.admission.check_config(model_name, int(nsamples), int(length))
+        if accepted:
             await ctx.send('Setting configuration. Please wait...')
+            await self.stop_pregen()
             logging.info('SHUTTING DOWN.')
             self.serverSessions[server_id].shutdown()
             logging.info('SET STATE.')
@@ -220,31 +521,30 @@ class GPT2Bot(commands.Cog):
             logging.info('PREINIT.')
             self.serverSessions[server_id].preinit_model()
             logging.info('SET SESSION.')
-            self.serverSessions[server_id].session = tf.Session()
+            self.serverSessions[server_id].start_session()
             await ctx.trigger_typing()
             logging.info('INIT MODEL.')
             self.serverSessions[server_id].init_model()
             await ctx.send('Succesfully set configuration!')
-            if (self.serverSessions[server_id].nsamples * self.serverSessions[server_id].length > 100):
-                await ctx.send('The configuration parameters are process intensive, responses may take a while.')
-                logging.info('COMPLETE.')
+            if (estimate > self.admission.warn_seconds):
+                await ctx.send('The configuration parameters are process intensive, responses may take about ' + str(round(estimate)) + ' seconds.')
+            logging.info('COMPLETE.')
         else:
-            await ctx.send('Configuration failed. The configuration parameters too process intensive.')
+            await ctx.send('Configuration failed. The configuration parameters too process intensive '
+                '(about ' + str(round(estimate)) + ' seconds per response, the limit is ' + str(self.admission.max_request_seconds) + ').')
             logging.info('FAILED. TOO INTENSVE')
 
     @commands.command()
     @commands.guild_only()
     @commands.has_permissions(administrator=True)
     async def debugsetconfig(self, ctx, nsamples: int, length: int, temp: float, top_k: int, model_name: str):
-        if (self.not_ready):
-            await ctx.send(self.not_ready_s)
+        if not await self.check_ready(ctx):
             return
         logging.info('SET CONFIGURATION.')
         if (self.is_interfering):
-            await ctx.send('Currently talking to someone. Try again later.')
+            await ctx.send(self.busy_text())
             return
-        if (self.not_ready):
-            await ctx.send(self.not_ready_s)
+        if not await self.check_ready(ctx):
             return
         if model_name not in self.models:
             await ctx.send('Model ' + model_name+ ' does not exist. Please choose a different model!')
@@ -254,6 +554,7 @@ class GPT2Bot(commands.Cog):
         await ctx.trigger_typing()
         await ctx.send('`CAUTION! Size limits are disabled. Please be considerate of everyone else who uses this. :)`')
         await ctx.send('`Setting configuration. Please wait...`')
+        await self.stop_pregen()
         logging.info('SHUTTING DOWN.')
         await ctx.send('`Shutting down tensorflow model...`')
         self.serverSessions[server_id].shutdown()
@@ -270,7 +571,7 @@ class GPT2Bot(commands.Cog):
         await ctx.send('`Preinit tensorflow model...`')
         self.serverSessions[server_id].preinit_model()
         logging.info('SET SESSION.')
-        self.serverSessions[server_id].session = tf.Session()
+        self.serverSessions[server_id].start_session()
         await ctx.trigger_typing()
         await ctx.send('`Setting up new tensorflow model...`')
         logging.info('INIT MODEL.')
@@ -286,30 +587,30 @@ class GPT2Bot(commands.Cog):
     @commands.guild_only()
     @commands.has_permissions(manage_messages=True)
     async def default(self, ctx):
-        if (self.not_ready):
-            await ctx.send(self.not_ready_s)
+        if not await self.check_ready(ctx):
             return
         logging.info('Setting to DEFAULT configuration.')
         if (self.is_interfering):
-            await ctx.send('Currently talking to someone. Try again later.')
+            await ctx.send(self.busy_text())
             return
-        if (self.not_ready):
-            await ctx.send(self.not_ready_s)
+        if not await self.check_ready(ctx):
             return
         server_id = ctx.message.guild.id
 
         await ctx.trigger_typing()
+        await self.stop_pregen()
         self.serverSessions[server_id].shutdown()
         self.serverSessions[server_id].set_state(1,200,1,0,'117M')
         await ctx.trigger_typing()
         self.serverSessions[server_id].preinit_model()
-        self.serverSessions[server_id].session = tf.Session()
+        self.serverSessions[server_id].start_session()
         await ctx.trigger_typing()
         self.serverSessions[server_id].init_model()
 
         await ctx.send('Succesfully set `default` configuration!')
 
     @default.error
+    @chatmode.error
     @helpconfig.error
     @setconfig.error
     @debugsetconfig.error
@@ -318,11 +619,22 @@ class GPT2Bot(commands.Cog):
         if isinstance(error, commands.MissingPermissions):
             text = "Sorry {}, you do not have permissions to do that!".format(ctx.message.author)
             await ctx.send(text)
+    @profiletalk.error
+    async def profiletalk_error(self, ctx, error):
+        if isinstance(error, commands.MissingPermissions):
+            text = "Sorry {}, you do not have permissions to do that!".format(ctx.message.author)
+            await ctx.send(text)
+        if isinstance(error, commands.errors.MissingRequiredArgument):
+            await ctx.send('Use `!profiletalk <message>` or `!profiletalk --python <message>`.')
+        if isinstance(error, commands.errors.CommandInvokeError):
+            logging.info(error.original)
+            await ctx.send('Profiling failed!')
+
     @talk.error
     @debugtalk.error
     async def talk_error(self, ctx, error):
         if isinstance(error, commands.errors.CommandInvokeError):
-            self.is_interfering=False
+            # The command already ended its generation and freed the bot.
             logging.info(error.original)
             print(error.original)
             await ctx.send('Command failed!')
@@ -331,59 +643,88 @@ class GPT2Bot(commands.Cog):
             #await ctx.send(text)
             logging.info('MSG being generated!')
             if (self.is_interfering):
-                await ctx.send('Currently talking to someone. Try again later.')
+                await ctx.send(self.busy_text())
                 return
-            if (self.not_ready):
-                await ctx.send(self.not_ready_s)
+            if not await self.check_ready(ctx):
                 return
             server_id = ctx.message.guild.id
+            session = self.serverSessions[server_id]
             logging.info('Guild: ' + str(server_id))
             self.is_interfering = True
-            for _ in range(self.serverSessions[server_id].nsamples):
-                async with ctx.typing():
-                    start = time.time()
-                    text_generator = functools.partial(self.serverSessions[server_id].generate_uncon_text)
-                    out = await self.bot.loop.run_in_executor(None, text_generator)
-                    response = self.serverSessions[server_id].enc.decode(out[0])
-                    logging.info('RESPONSE GENERATED IN :' + str(round(time.time() - start, 2)) + ' seconds.')
-                    logging.info('RESPONSE: ' + response)
-                    logging.info('RESPONSE LEN: ' + str(len(response)))
-
-                    response_chunk = 0
-                    chunk_size = 1990
-                    if (len(response) > 2000):
-                        while (len(response) > response_chunk):
-                            await ctx.send(response[response_chunk:response_chunk + chunk_size])
-                            response_chunk += chunk_size
-                    else:
-                        await ctx.send(response)
-
-            self.is_interfering = False
+            job = None
+            cancel = self.start_generation(ctx)
+            try:
+                job = await self.admit(ctx, session, 0)
+                for _ in range(session.nsamples):
+                    if cancel.cancelled():
+                        break
+                    async with ctx.typing():
+                        start = time.time()
+                        pregenerated = self.pregen.take(session)
+                        if pregenerated is not None:
+                            logging.info('SERVED PREGENERATED SAMPLE.')
+                            out = [pregenerated]
+                        else:
+                            text_generator = functools.partial(session.generate_uncon_text, cancel=cancel)
+                            out = await self.bot.loop.run_in_executor(self.executor_for(session), text_generator)
+                            self.admission.record(session.model_name, len(out[0]), time.time() - start)
+                        response = session.enc.decode(out[0])
+                        logging.info('RESPONSE GENERATED IN :' + str(round(time.time() - start, 2)) + ' seconds.')
+                        logging.info('RESPONSE: ' + response)
+                        logging.info('RESPONSE LEN: ' + str(len(response)))
+                        response = self.cut_short(response, cancel)
+                        if response is None:
+                            break
+                        self.sender.send(ctx.channel, response, reply=True)
+            except Exception as e:
+                self.stopped_error(cancel, e)
+            finally:
+                self.end_generation(ctx, job)
 
     @commands.Cog.listener()
     async def on_guild_join(self, guild):
         logging.info('Joined Guild.')
-        self.serverSessions[guild.id] = gpt2_server_sessions(guild.id)
+        if guild.id not in self.guildIdList:
+            self.guildIdList.append(guild.id)
+        await self.load_sessions([guild.id])
         logging.info('Spawned GPT-2 for new guild')
 
     @commands.Cog.listener()
     async def on_guild_remove(self, guild):
         logging.info('Removed from Guild.')
-        self.serverSessions[guild.id].shutdown()
+        if guild.id in self.guildIdList:
+            self.guildIdList.remove(guild.id)
+        self.failed_guilds.pop(guild.id, None)
+        self.cancel_generations('guild removed', guild_id=guild.id)
+        await self.stop_pregen()
+        session = self.serverSessions.pop(guild.id, None)
+        if session is not None:
+            session.shutdown()
         logging.info('Despawned GPT-2 for said guild')
 
+    # The raw events fire for every message, not only those in discord.py's message cache,
+    # which older messages fetched for chat prompts usually aren't.
+    @commands.Cog.listener()
+    async def on_raw_message_delete(self, payload):
+        self.token_cache.invalidate(payload.message_id)
+        if payload.message_id in self.generations:
+            self.generations[payload.message_id][0].cancel('message deleted')
+
+    @commands.Cog.listener()
+    async def on_raw_message_edit(self, payload):
+        self.token_cache.invalidate(payload.message_id)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_delete(self, channel):
+        self.cancel_generations('channel deleted', channel_id=channel.id)
+        self.chat_starts.pop(channel.id, None)
+        if channel.guild.id in self.serverSessions:
+            self.serverSessions[channel.guild.id].forget_channel(channel.id)
+
     @commands.Cog.listener()
     async def on_ready(self):
         if self.not_ready:
-            self.not_ready = False
-            guilds = await self.bot.fetch_guilds(limit=150).flatten()
-            for guild in guilds:
-                self.guildIdList.append(guild.id)
-            self.serverSessions = {}
-            for serverid in self.guildIdList:
-                self.serverSessions[serverid] = gpt2_server_sessions(serverid)
-                logging.info('Spawned GPT-2')
-                self.not_ready = False
+            await self.load_guilds()
 
 def setup(bot):
     bot.add_cog(GPT2Bot(bot))
@@ -0,0 +1,130 @@
+import json
+import time
+import logging
+import threading
+import urllib.error
+import urllib.request
+import numpy as np
+from gpt2_server_sessions import gpt2_server_sessions, load_encoder, load_hparams
+from src import model
+
+class InferenceBackends:
+    """Spreads requests over inference servers, preferring the one with the fewest requests
+    in flight and skipping servers that recently failed."""
+
+    def __init__(self, urls, timeout=600, retry_after=30):
+        self.urls = [url.rstrip('/') for url in urls]
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.inflight = {url: 0 for url in self.urls}
+        self.failed_at = {}
+        self.lock = threading.Lock()
+
+    def pick(self, exclude=()):
+        with self.lock:
+            now = time.time()
+            candidates = [url for url in self.urls if url not in exclude
+                and now - self.failed_at.get(url, 0) > self.retry_after]
+            if not candidates:
+                # Everything failed recently; retrying beats refusing outright.
+                candidates = [url for url in self.urls if url not in exclude]
+            if not candidates:
+                return None
+            url = min(candidates, key=lambda u: self.inflight[u])
+            self.inflight[url] += 1
+            return url
+
+    def release(self, url, failed=False):
+        with self.lock:
+            self.inflight[url] -= 1
+            if failed:
+                self.failed_at[url] = time.time()
+            else:
+                self.failed_at.pop(url, None)
+
+    def post(self, path, body):
+        tried = []
+        while True:
+            url = self.pick(exclude=tried)
+            if url is None:
+                raise ConnectionError('No inference backend available, tried: ' + ', '.join(tried))
+            tried.append(url)
+            request = urllib.request.Request(url + path, data=json.dumps(body).encode('utf-8'),
+                headers={'Content-Type': 'application/json'})
+            failed = True
+            try:
+                with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                    result = json.loads(response.read())
+                failed = False
+                return result
+            except urllib.error.HTTPError as e:
+                if e.code < 500:
+                    # The request is at fault, not the server, it would fail on every backend.
+                    failed = False
+                    raise
+                logging.error('Backend ' + url + ' failed: ' + str(e))
+            except (OSError, ValueError) as e:
+                logging.error('Backend ' + url + ' failed: ' + str(e))
+            finally:
+                self.release(url, failed=failed)
+
+    def get(self, url, path):
+        with urllib.request.urlopen(url + path, timeout=10) as response:
+            return json.loads(response.read())
+
+    def health(self):
+        status = {}
+        for url in self.urls:
+            try:
+                status[url] = self.get(url, '/health')
+            except OSError as e:
+                status[url] = {'status': 'down', 'error': str(e)}
+        return status
+
+class remote_server_sessions(gpt2_server_sessions):
+    """A guild session that keeps its configuration and encoder locally and generates on
+    inference servers instead of in a local tensorflow session."""
+
+    def __init__(self, server_id, backends, config=None, bot_config=None):
+        self.backends = backends
+        super().__init__(server_id, config, bot_config)
+
+    def preinit_model(self):
+        self.enc = load_encoder(self.model_name)
+        self.hparams = model.default_hparams()
+        self.hparams.override_from_dict(load_hparams(self.model_name))
+
+    def start_session(self):
+        pass
+
+    def init_model(self):
+        pass
+
+    def shutdown(self):
+        pass
+
+    def forget_channel(self, channel_id):
+        pass
+
+    def request(self, tokens, length, cancel=None):
+        """Generate on a backend. The deadline goes along and is enforced by the server, other
+        cancellation can only skip a request that hasn't been sent yet."""
+        body = {
+            'tokens': tokens,
+            'model_name': self.model_name,
+            'length': self.length if length is None else length,
+            'temperature': self.temperature,
+            'top_k': self.top_k,
+        }
+        if cancel is not None:
+            if cancel.cancelled():
+                return {'tokens': []}
+            if cancel.deadline is not None:
+                body['deadline'] = cancel.remaining()
+        return self.backends.post('/generate', body)
+
+    def generate_text(self, context_tokens, length=None, cache_key=None, cancel=None):
+        return np.array([self.request(list(context_tokens), length, cancel)['tokens']])
+
+    def generate_uncon_text(self, length=None, cancel=None):
+        return np.array([self.request(None, length, cancel)['tokens']])
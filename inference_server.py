@@ -0,0 +1,218 @@
+#!/usr/bin/python3
+"""Standalone GPT-2 inference service.
+
+Serves token-level generation over HTTP so the Discord bot can run as a thin client
+(see inference_client.py) on a different host than the models.
+
+    GET  /health    liveness and the loaded models
+    GET  /stats     request counts and tokens/sec per model
+    POST /generate  {"tokens": [...] or null, "model_name", "length", "temperature", "top_k",
+                     "deadline": seconds after which to stop and answer with what was generated}
+    POST /stream    same body, answers with one JSON line per generated run
+"""
+import json
+import time
+import logging
+import argparse
+import threading
+import socketserver
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from gpt2_server_sessions import gpt2_server_sessions
+from cancellation import CancelToken
+from bot_config import load_bot_config
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    # http.server only has this from python 3.7, tensorflow 1.12 stops at 3.6.
+    daemon_threads = True
+
+class ModelPool:
+    """One loaded session per model, least recently used first out.
+
+    Temperature and top_k are fed per request, so every sampling configuration shares the
+    model's session. Models load outside the lock, and an evicted session is only shut
+    down once the requests still running on it are done.
+    """
+
+    def __init__(self, max_sessions=2, stream_step=32, bot_config=None):
+        self.bot_config = bot_config
+        self.max_sessions = max_sessions
+        self.stream_step = stream_step
+        self.sessions = OrderedDict()
+        # Model name to an event set once its loading finished, for requests that wait on it.
+        self.loading = {}
+        # Requests in flight per session, and evicted sessions that still have some.
+        self.users = {}
+        self.retired = []
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.inflight = 0
+
+    def acquire(self, model_name):
+        """The session for model_name, loaded if needed. Hand it back with release()."""
+        while True:
+            with self.lock:
+                if model_name in self.sessions:
+                    self.sessions.move_to_end(model_name)
+                    session = self.sessions[model_name]
+                    self.users[session] = self.users.get(session, 0) + 1
+                    self.inflight += 1
+                    return session
+                loaded = self.loading.get(model_name)
+                if loaded is None:
+                    loaded = self.loading[model_name] = threading.Event()
+                    break
+            # Someone else is loading it, look again once they are done.
+            loaded.wait()
+        try:
+            logging.info('LOADING ' + model_name)
+            session = gpt2_server_sessions('backend', config={'model_name': model_name}, bot_config=self.bot_config)
+        finally:
+            with self.lock:
+                del self.loading[model_name]
+            loaded.set()
+        with self.lock:
+            self.sessions[model_name] = session
+            self.users[session] = 1
+            self.inflight += 1
+            while len(self.sessions) > self.max_sessions:
+                _, evicted = self.sessions.popitem(last=False)
+                logging.info('EVICTING ' + evicted.model_name)
+                self.retired.append(evicted)
+            idle = self.pop_idle()
+        for evicted in idle:
+            evicted.shutdown()
+        return session
+
+    def release(self, session):
+        with self.lock:
+            self.users[session] -= 1
+            self.inflight -= 1
+            idle = self.pop_idle()
+        for evicted in idle:
+            evicted.shutdown()
+
+    def pop_idle(self):
+        """Take the evicted sessions nobody is using anymore, call with the lock held."""
+        idle = [session for session in self.retired if not self.users[session]]
+        for session in idle:
+            self.retired.remove(session)
+            del self.users[session]
+        return idle
+
+    def record(self, model_name, tokens, seconds):
+        with self.lock:
+            stats = self.stats.setdefault(model_name, {'requests': 0, 'tokens': 0, 'seconds': 0.0})
+            stats['requests'] += 1
+            stats['tokens'] += tokens
+            stats['seconds'] += seconds
+
+    def snapshot(self):
+        with self.lock:
+            stats = {}
+            for model_name, s in self.stats.items():
+                stats[model_name] = dict(s, tokens_per_sec=s['tokens'] / max(s['seconds'], 1e-6))
+            return {
+                'inflight': self.inflight,
+                'loaded': list(self.sessions),
+                'models': stats,
+            }
+
+class InferenceHandler(BaseHTTPRequestHandler):
+
+    pool = None
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.send_json({'status': 'ok', 'loaded': list(self.pool.sessions)})
+        elif self.path == '/stats':
+            self.send_json(self.pool.snapshot())
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        if self.path not in ('/generate', '/stream'):
+            self.send_error(404)
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            model_name = request['model_name']
+            sampling = {
+                'temperature': float(request.get('temperature', 1)),
+                'top_k': int(request.get('top_k', 0)),
+            }
+            deadline = request.get('deadline')
+            cancel = CancelToken(None if deadline is None else float(deadline))
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_error(400, str(e))
+            return
+        try:
+            session = self.pool.acquire(model_name)
+        except Exception as e:
+            logging.error('Failed to load ' + str(model_name) + ': ' + str(e))
+            self.send_error(503, str(e))
+            return
+        try:
+            if self.path == '/generate':
+                self.generate(session, request, sampling, cancel)
+            else:
+                self.stream(session, request, sampling, cancel)
+        finally:
+            self.pool.release(session)
+
+    def generate(self, session, request, sampling, cancel):
+        start = time.time()
+        length = int(request.get('length', session.length))
+        if request.get('tokens'):
+            out = session.generate_text(request['tokens'], length, cancel=cancel, sampling=sampling)
+        else:
+            out = session.generate_uncon_text(length, cancel=cancel, sampling=sampling)
+        seconds = time.time() - start
+        self.pool.record(session.model_name, len(out[0]), seconds)
+        self.send_json({'tokens': [int(t) for t in out[0]], 'seconds': seconds})
+
+    def stream(self, session, request, sampling, cancel):
+        start = time.time()
+        length = int(request.get('length', session.length))
+        tokens = request.get('tokens') or [session.enc.encoder['<|endoftext|>']]
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        generated = 0
+        for out in session.iter_text(tokens, length, max_step=self.pool.stream_step, sampling=sampling, cancel=cancel):
+            generated += len(out)
+            self.wfile.write((json.dumps({'tokens': [int(t) for t in out]}) + '\n').encode('utf-8'))
+            self.wfile.flush()
+        seconds = time.time() - start
+        self.pool.record(session.model_name, generated, seconds)
+        self.wfile.write((json.dumps({'done': True, 'seconds': seconds}) + '\n').encode('utf-8'))
+
+    def send_json(self, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logging.info('HTTP ' + (format % args))
+
+def main():
+    parser = argparse.ArgumentParser(description='GPT-2 inference server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-sessions', type=int, default=2, help='Models kept loaded at once')
+    parser.add_argument('--preload', nargs='*', default=[], help='Models to load before serving, e.g. 1558M')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    InferenceHandler.pool = ModelPool(max_sessions=args.max_sessions, bot_config=load_bot_config())
+    for model_name in args.preload:
+        InferenceHandler.pool.release(InferenceHandler.pool.acquire(model_name))
+    server = ThreadingHTTPServer((args.host, args.port), InferenceHandler)
+    logging.info('Serving GPT-2 on ' + args.host + ':' + str(args.port))
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
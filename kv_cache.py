@@ -0,0 +1,74 @@
+import threading
+from collections import OrderedDict
+
+def common_prefix(a, b):
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+class KVCache:
+    """Token history and its KV presents per key, a (guild, channel) pair. Least recently
+    used entries are evicted once the presents take more than max_bytes."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        # Prompts looked up, how many reused cached presents, and the tokens involved.
+        self.lookups = 0
+        self.hits = 0
+        self.prompt_tokens = 0
+        self.reused_tokens = 0
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, tokens, presents):
+        with self.lock:
+            self.discard(key)
+            if presents.nbytes > self.max_bytes:
+                return
+            self.entries[key] = (list(tokens), presents)
+            self.nbytes += presents.nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    def pop(self, key):
+        with self.lock:
+            self.discard(key)
+
+    def record(self, reused, prompt_tokens):
+        """Count a prompt that reused reused of its prompt_tokens tokens from the cache,
+        returns a summary of the hit rate so far."""
+        with self.lock:
+            self.lookups += 1
+            self.hits += 1 if reused else 0
+            self.prompt_tokens += prompt_tokens
+            self.reused_tokens += reused
+            return '%d of %d prompts hit (%.0f%%), %.0f%% of prompt tokens reused' % (
+                self.hits, self.lookups, 100.0 * self.hits / self.lookups,
+                100.0 * self.reused_tokens / max(self.prompt_tokens, 1))
+
+    def pop_guild(self, guild_id):
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == guild_id]:
+                self.discard(key)
+
+    def discard(self, key):
+        if key in self.entries:
+            _, presents = self.entries.pop(key)
+            self.nbytes -= presents.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
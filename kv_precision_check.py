@@ -0,0 +1,117 @@
+#!/usr/bin/python3
+"""Compare next-token predictions with reduced precision KV storage against float32.
+
+Every prompt is split in two: the first part is run through the model to produce the
+past keys/values, stored as float32 and as the tested type, and the second part is
+scored on top of each. Reports the largest logit difference, the mean KL divergence of
+the next-token distributions and how often the top token agrees, both for the prefill
+path and for the single-token decode path used while sampling.
+
+With --check-step it instead checks, in float32, that the decode path (model.model_step)
+gives the same logits as model.model for the same past, and exits non-zero if not.
+
+    python3 kv_precision_check.py --model 1558M --dtype float16
+    python3 kv_precision_check.py --model 117M --check-step
+"""
+import os
+import sys
+import json
+import argparse
+import numpy as np
+import tensorflow as tf
+from src import model, encoder
+
+PROMPTS = [
+    "The quick brown fox jumps over the lazy dog, and then it runs off into the forest where nobody can find it.",
+    "In a shocking finding, scientist discovered a herd of unicorns living in a remote, previously unexplored valley in the Andes Mountains.",
+    "Discord servers are online communities where people chat about games, music, programming and whatever else they have in common.",
+]
+
+def with_kv_dtype(hparams, kv_dtype):
+    copy = model.default_hparams()
+    copy.override_from_dict(hparams.values())
+    copy.set_hparam('kv_dtype', kv_dtype)
+    return copy
+
+def build(hparams, prefix, rest):
+    """Logits of rest after the past of prefix, through model.model and model.model_step."""
+    past = model.model(hparams=hparams, X=prefix)['present']
+    prefill_logits = model.model(hparams=hparams, X=rest, past=past)['logits'][0]
+    step_logits = model.model_step(hparams=hparams, X=rest[:, 0], past=past)['logits']
+    return prefill_logits, step_logits
+
+def log_softmax(x):
+    x = x - x.max(axis=-1, keepdims=True)
+    return x - np.log(np.exp(x).sum(axis=-1, keepdims=True))
+
+def compare(reference, test):
+    p, q = log_softmax(reference), log_softmax(test)
+    kl = (np.exp(p) * (p - q)).sum(axis=-1)
+    return {
+        'max_abs_diff': float(np.abs(reference - test).max()),
+        'mean_kl': float(kl.mean()),
+        'top1_agreement': float((reference.argmax(axis=-1) == test.argmax(axis=-1)).mean()),
+    }
+
+def check_step(results, tolerance):
+    """Report model_step against model.model, True if they agree within tolerance."""
+    worst = max(r['max_abs_diff'] for r in results)
+    print('model_step against model.model on %d prompts: max |logit diff| %.6f, mean KL %.8f, top-1 agreement %.1f%%' % (
+        len(results), worst, np.mean([r['mean_kl'] for r in results]),
+        100 * np.mean([r['top1_agreement'] for r in results])))
+    if worst > tolerance:
+        print('FAILED: the decode path differs from model.model by more than %g.' % tolerance)
+        return False
+    print('OK')
+    return True
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the quality impact of reduced precision KV storage')
+    parser.add_argument('--model', default='117M')
+    parser.add_argument('--dtype', default='float16', choices=['float16', 'bfloat16'])
+    parser.add_argument('--prompts', help='File with one prompt per line, defaults to a few built-in ones')
+    parser.add_argument('--check-step', action='store_true', help='Check model_step against model.model in float32 instead')
+    parser.add_argument('--tolerance', type=float, default=1e-3, help='Largest logit difference --check-step accepts')
+    args = parser.parse_args()
+
+    enc = encoder.get_encoder(args.model)
+    hparams = model.default_hparams()
+    with open(os.path.join('models', args.model, 'hparams.json')) as f:
+        hparams.override_from_dict(json.load(f))
+    prompts = PROMPTS
+    if args.prompts:
+        with open(args.prompts, encoding='utf-8') as f:
+            prompts = [line.strip() for line in f if line.strip()]
+
+    with tf.Session(graph=tf.Graph()) as sess:
+        prefix = tf.placeholder(tf.int32, [1, None])
+        rest = tf.placeholder(tf.int32, [1, None])
+        reference = build(with_kv_dtype(hparams, 'float32'), prefix, rest)
+        test = reference if args.check_step else build(with_kv_dtype(hparams, args.dtype), prefix, rest)
+        saver = tf.train.Saver()
+        saver.restore(sess, tf.train.latest_checkpoint(os.path.join('models', args.model)))
+
+        results = {'prefill': [], 'decode': [], 'step': []}
+        for prompt in prompts:
+            tokens = enc.encode(prompt)[:hparams.n_ctx]
+            split = len(tokens) // 2
+            feed_dict = {prefix: [tokens[:split]], rest: [tokens[split:]]}
+            ref_prefill, ref_step, test_prefill, test_step = sess.run(reference + test, feed_dict=feed_dict)
+            # The first row of the prefill logits is the first token of rest after the same past.
+            results['step'].append(compare(ref_prefill[:1], ref_step))
+            results['prefill'].append(compare(ref_prefill, test_prefill))
+            results['decode'].append(compare(ref_step, test_step))
+
+    if args.check_step:
+        sys.exit(0 if check_step(results.pop('step'), args.tolerance) else 1)
+    results.pop('step')
+
+    print('%s KV storage against float32 on %d prompts (%s):' % (args.dtype, len(prompts), args.model))
+    for path, rows in results.items():
+        print('%-8s max |logit diff| %.4f, mean KL %.6f, top-1 agreement %.1f%%' % (path,
+            max(r['max_abs_diff'] for r in rows),
+            np.mean([r['mean_kl'] for r in rows]),
+            100 * np.mean([r['top1_agreement'] for r in rows])))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,272 @@
+#!/usr/bin/python3
+"""Load test the GPT2Bot cog without Discord or real models.
+
+Fake guilds send talk, unconditional talk, setconfig and default commands at a Poisson
+arrival rate, and new guilds join while the test runs. The guild sessions are stubs that
+sleep for as long as the configured model would take, so the numbers reflect queuing,
+admission and sending in the cog rather than tensorflow. Latency runs from the command to
+the last message sent to its channel.
+
+    python3 loadtest.py --guilds 300 --rate 2 --duration 60
+"""
+import os
+import time
+import random
+import asyncio
+import inspect
+import logging
+import argparse
+import tempfile
+from discord.ext import commands
+from gptchatbot import GPT2Bot
+
+# Tokens/sec the stub sessions pretend to generate at.
+STUB_SPEEDS = {
+    '117M': 400.0,
+    '345M': 150.0,
+    '774M': 70.0,
+    '1558M': 30.0,
+}
+
+# Replies that mean the cog turned the request away.
+REJECTED_PREFIXES = ('Currently talking to someone.', 'Configuration failed.')
+
+class StubEncoder:
+
+    def encode(self, text):
+        return [len(word) for word in text.split()]
+
+    def decode(self, tokens):
+        return ' word' * len(tokens)
+
+class StubSession:
+    """Stands in for gpt2_server_sessions, generation just takes the time the model would."""
+
+    def __init__(self, server_id, speeds=STUB_SPEEDS):
+        self.server_id = server_id
+        self.speeds = speeds
+        self.enc = StubEncoder()
+        self.server_configs = {}
+        self.timings = {}
+        self.init_state()
+
+    def init_state(self, nsamples=1, length=200, temperature=1, top_k=40, model_name='117M'):
+        self.nsamples = nsamples
+        self.length = length
+        self.temperature = temperature
+        self.top_k = top_k
+        self.model_name = model_name
+
+    def set_state(self, nsamples, length, temperature, top_k, model_name='117M'):
+        self.init_state(nsamples, length, temperature, top_k, model_name)
+
+    def preinit_model(self):
+        pass
+
+    def start_session(self):
+        pass
+
+    def init_model(self):
+        time.sleep(0.05)
+
+    def shutdown(self):
+        pass
+
+    def forget_channel(self, channel_id):
+        pass
+
+    def generate(self, length, cancel=None):
+        # A token at a time in chunks, so cancellation and deadlines stop it like the real one.
+        generated = 0
+        while generated < length and not (cancel is not None and cancel.cancelled()):
+            step = min(16, length - generated)
+            time.sleep(step / self.speeds[self.model_name])
+            generated += step
+        return [[0] * generated]
+
+    def generate_text(self, context_tokens, length=None, cache_key=None, cancel=None):
+        return self.generate(self.length if length is None else length, cancel)
+
+    def generate_uncon_text(self, length=None, cancel=None):
+        return self.generate(self.length if length is None else length, cancel)
+
+class FakeTyping:
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+class FakeChannel:
+
+    def __init__(self, channel_id):
+        self.id = channel_id
+        self.sent = []
+
+    async def send(self, content=None, file=None):
+        self.sent.append((time.time(), content))
+
+class FakeGuild:
+
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.channel = FakeChannel(guild_id * 10)
+
+class FakeMessage:
+
+    def __init__(self, guild):
+        self.id = random.getrandbits(63)
+        self.guild = guild
+        self.author = 'loadtest#' + str(guild.id)
+
+class FakeContext:
+    """Just enough of commands.Context for the cog, records everything sent through it."""
+
+    def __init__(self, guild):
+        self.message = FakeMessage(guild)
+        self.channel = guild.channel
+        self.sent = []
+
+    async def send(self, content=None, file=None):
+        self.sent.append(content)
+        self.channel.sent.append((time.time(), content))
+
+    async def trigger_typing(self):
+        pass
+
+    def typing(self):
+        return FakeTyping()
+
+class FakeBot:
+
+    def __init__(self, loop):
+        self.loop = loop
+
+class LoadTest:
+
+    def __init__(self, guilds, rate, duration, join_rate, mix, deadline=None):
+        self.guild_count = guilds
+        self.deadline = deadline
+        self.rate = rate
+        self.duration = duration
+        self.join_rate = join_rate
+        self.mix = mix
+        self.results = []
+
+    async def setup(self, loop):
+        self.cog = GPT2Bot(FakeBot(loop))
+        self.cog.session_factory = StubSession
+        self.cog.models = list(STUB_SPEEDS)
+        if self.deadline is not None:
+            self.cog.config['generation_deadline'] = self.deadline
+        self.guilds = []
+        for guild_id in range(1, self.guild_count + 1):
+            await self.join(guild_id)
+        self.cog.not_ready = False
+
+    async def join(self, guild_id):
+        guild = FakeGuild(guild_id)
+        await self.cog.on_guild_join(guild)
+        self.guilds.append(guild)
+
+    async def invoke(self, command, ctx):
+        """Run a command the way discord.ext.commands would, errors go to the error handler."""
+        if command == 'talk':
+            coro = GPT2Bot.talk.callback(self.cog, ctx, message='tell me a story about load tests')
+            handler = self.cog.talk_error
+        elif command == 'uncon':
+            parameter = inspect.Parameter('message', inspect.Parameter.KEYWORD_ONLY)
+            await self.cog.talk_error(ctx, commands.MissingRequiredArgument(parameter))
+            return
+        elif command == 'setconfig':
+            model_name = random.choice(list(STUB_SPEEDS))
+            coro = GPT2Bot.setconfig.callback(self.cog, ctx, 1, random.choice([50, 100, 200]), 1.0, 40, model_name)
+            handler = self.cog.default_error
+        else:
+            coro = GPT2Bot.default.callback(self.cog, ctx)
+            handler = self.cog.default_error
+        try:
+            await coro
+        except Exception as e:
+            await handler(ctx, commands.CommandInvokeError(e))
+
+    async def request(self, command, guild):
+        ctx = FakeContext(guild)
+        start = time.time()
+        await self.invoke(command, ctx)
+        # Responses go out through the cog's OutputSender, wait until they are sent.
+        await self.cog.sender.flush(guild.channel)
+        latency = max([t for t, _ in guild.channel.sent if t >= start], default=time.time()) - start
+        if any(content and content.startswith(REJECTED_PREFIXES) for content in ctx.sent):
+            outcome = 'rejected'
+        elif 'Command failed!' in ctx.sent:
+            outcome = 'failed'
+        else:
+            outcome = 'ok'
+        self.results.append((command, outcome, latency))
+
+    async def run(self, loop):
+        await self.setup(loop)
+        commands_, weights = zip(*self.mix.items())
+        tasks = []
+        start = time.time()
+        next_join = start + random.expovariate(self.join_rate) if self.join_rate else None
+        while time.time() - start < self.duration:
+            await asyncio.sleep(random.expovariate(self.rate))
+            command = random.choices(commands_, weights)[0]
+            tasks.append(loop.create_task(self.request(command, random.choice(self.guilds))))
+            if next_join is not None and time.time() >= next_join:
+                await self.join(len(self.guilds) + 1)
+                next_join = time.time() + random.expovariate(self.join_rate)
+        await asyncio.gather(*tasks)
+        return time.time() - start
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def report(results, elapsed):
+    print('%-10s %8s %8s %8s %8s %8s %8s %8s' % ('command', 'sent', 'ok', 'rejected', 'failed', 'p50', 'p90', 'p99'))
+    for command in sorted(set(r[0] for r in results)) + ['all']:
+        rows = [r for r in results if command in ('all', r[0])]
+        ok = [latency for _, outcome, latency in rows if outcome == 'ok']
+        rejected = sum(1 for r in rows if r[1] == 'rejected')
+        failed = sum(1 for r in rows if r[1] == 'failed')
+        print('%-10s %8d %8d %8d %8d %7.2fs %7.2fs %7.2fs' % (command, len(rows), len(ok), rejected, failed,
+            percentile(ok, 50), percentile(ok, 90), percentile(ok, 99)))
+    completed = sum(1 for r in results if r[1] == 'ok')
+    print('throughput: %.2f completed requests/sec, rejection rate: %.1f%%' % (completed / elapsed,
+        100 * sum(1 for r in results if r[1] == 'rejected') / max(len(results), 1)))
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the GPT2Bot cog with fake guilds')
+    parser.add_argument('--guilds', type=int, default=200)
+    parser.add_argument('--rate', type=float, default=2.0, help='Commands per second over all guilds')
+    parser.add_argument('--duration', type=float, default=30.0, help='Seconds to send commands for')
+    parser.add_argument('--join-rate', type=float, default=0.1, help='Guild joins per second')
+    parser.add_argument('--talk', type=float, default=85, help='Weight of !talk with a message')
+    parser.add_argument('--uncon', type=float, default=8, help='Weight of !talk without a message')
+    parser.add_argument('--setconfig', type=float, default=5, help='Weight of !setconfig')
+    parser.add_argument('--default', type=float, default=2, help='Weight of !default')
+    parser.add_argument('--deadline', type=float, help='generation_deadline in seconds, to exercise stopping generations')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    random.seed(args.seed)
+    mix = {'talk': args.talk, 'uncon': args.uncon, 'setconfig': args.setconfig, 'default': args.default}
+    test = LoadTest(args.guilds, args.rate, args.duration, args.join_rate, mix, args.deadline)
+    # The cog reads models/ and config/ from the working directory, give it a throwaway one.
+    with tempfile.TemporaryDirectory() as workdir:
+        for model_name in STUB_SPEEDS:
+            os.makedirs(os.path.join(workdir, 'models', model_name))
+        os.chdir(workdir)
+        loop = asyncio.get_event_loop()
+        elapsed = loop.run_until_complete(test.run(loop))
+    report(test.results, elapsed)
+
+if __name__ == '__main__':
+    main()
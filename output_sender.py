@@ -0,0 +1,127 @@
+import io
+import time
+import asyncio
+import logging
+import discord
+from collections import deque, OrderedDict
+
+MESSAGE_LIMIT = 2000
+# Put between texts that share a message, so separate samples stay told apart.
+SEPARATOR = '\n\n- - -\n\n'
+
+class OutputSender:
+    """Sends generated text to Discord in the background, one worker per channel.
+
+    Queued texts are coalesced into as few messages as fit the message limit, texts
+    longer than attachment_threshold are sent as a file, and every channel is held to
+    Discord's message bucket (rate messages every per seconds) before the API has to
+    answer with a 429. The ids of the messages generated replies went out in are kept,
+    so chat prompts can tell them apart from the bot's other messages.
+    """
+
+    def __init__(self, loop, chunk_size=1990, attachment_threshold=6000, rate=5, per=5.0, max_replies=20000):
+        self.loop = loop
+        self.chunk_size = chunk_size
+        self.attachment_threshold = attachment_threshold
+        self.rate = rate
+        self.per = per
+        self.queues = {}
+        self.workers = {}
+        self.buckets = {}
+        self.max_replies = max_replies
+        self.replies = OrderedDict()
+
+    def send(self, channel, text, reply=False):
+        """Queue text for channel and return without waiting for Discord. reply marks
+        generated text, see is_reply."""
+        queue = self.queues.get(channel.id)
+        if queue is None:
+            queue = self.queues[channel.id] = asyncio.Queue()
+            self.workers[channel.id] = self.loop.create_task(self.worker(channel, queue))
+        queue.put_nowait((text, reply))
+
+    def is_reply(self, message_id):
+        """Whether message_id is a message sent for generated text, as far as this process knows."""
+        return message_id in self.replies
+
+    async def flush(self, channel):
+        """Wait until everything queued for channel has been sent."""
+        worker = self.workers.get(channel.id)
+        if worker is not None:
+            await asyncio.shield(worker)
+
+    async def worker(self, channel, queue):
+        try:
+            while not queue.empty():
+                pending = []
+                while not queue.empty():
+                    pending.append(queue.get_nowait())
+                for content, file_text, reply in self.coalesce(pending):
+                    await self.wait_for_bucket(channel.id)
+                    try:
+                        message = await self.deliver(channel, content, file_text)
+                        # An attachment's message only holds a notice, not the text itself.
+                        if reply and file_text is None and message is not None:
+                            self.replies[message.id] = True
+                            while len(self.replies) > self.max_replies:
+                                self.replies.popitem(last=False)
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as e:
+                        # Connection errors and timeouts too, one lost message mustn't stop the channel.
+                        logging.error('Failed to send to channel ' + str(channel.id) + ': ' + repr(e))
+        finally:
+            # Nothing is awaited between the empty check and this, so no text can be lost.
+            # If the worker died anyway the next send() starts a new one.
+            if self.queues.get(channel.id) is queue:
+                del self.queues[channel.id]
+                del self.workers[channel.id]
+
+    def coalesce(self, texts):
+        """Turn queued (text, reply) items into (content, file_text, reply) pieces that each
+        fit one message. Replies and other texts never share a message."""
+        pieces = []
+        current = ''
+        current_reply = False
+        for text, reply in texts:
+            if not text:
+                continue
+            if current and reply != current_reply:
+                pieces.append((current, None, current_reply))
+                current = ''
+            if len(text) > self.attachment_threshold:
+                if current:
+                    pieces.append((current, None, current_reply))
+                    current = ''
+                pieces.append((None, text, reply))
+            elif len(text) > MESSAGE_LIMIT:
+                if current:
+                    pieces.append((current, None, current_reply))
+                    current = ''
+                for i in range(0, len(text), self.chunk_size):
+                    pieces.append((text[i:i + self.chunk_size], None, reply))
+            elif current and len(current) + len(SEPARATOR) + len(text) <= MESSAGE_LIMIT:
+                current += SEPARATOR + text
+            else:
+                if current:
+                    pieces.append((current, None, current_reply))
+                current = text
+                current_reply = reply
+        if current:
+            pieces.append((current, None, current_reply))
+        return pieces
+
+    async def wait_for_bucket(self, channel_id):
+        sent = self.buckets.setdefault(channel_id, deque(maxlen=self.rate))
+        if len(sent) == self.rate:
+            delay = self.per - (time.monotonic() - sent[0])
+            if delay > 0:
+                await asyncio.sleep(delay)
+        sent.append(time.monotonic())
+
+    async def deliver(self, channel, content, file_text):
+        if file_text is None:
+            return await channel.send(content)
+        else:
+            attachment = discord.File(io.BytesIO(file_text.encode('utf-8')), filename='response.txt')
+            return await channel.send('Response is ' + str(len(file_text)) + ' characters long, see the attached file.', file=attachment)
@@ -0,0 +1,35 @@
+from collections import deque
+
+class PregenPool:
+    """Unconditional samples generated ahead of time, kept per sampling configuration so
+    every guild using the same settings can be served from them."""
+
+    def __init__(self, size):
+        self.size = size
+        self.samples = {}
+
+    def key(self, session):
+        return (session.model_name, session.length, session.temperature, session.top_k)
+
+    def take(self, session):
+        samples = self.samples.get(self.key(session))
+        if not samples:
+            return None
+        return samples.popleft()
+
+    def put(self, key, tokens):
+        self.samples.setdefault(key, deque(maxlen=self.size)).append(tokens)
+
+    def wanted(self, sessions):
+        """A session whose configuration is short of samples, or None if all pools are full."""
+        for session in sessions:
+            if len(self.samples.get(self.key(session), ())) < self.size:
+                return session
+        return None
+
+    def prune(self, sessions):
+        """Drop samples for configurations no session uses anymore."""
+        keys = set(self.key(session) for session in sessions)
+        for key in list(self.samples):
+            if key not in keys:
+                del self.samples[key]
@@ -0,0 +1,64 @@
+import os
+import io
+import time
+import pstats
+import logging
+from collections import defaultdict
+from tensorflow.python.client import timeline
+
+PROFILE_PATH = 'profiles'
+
+def profile_dir(server_id):
+    path = os.path.join(PROFILE_PATH, str(server_id) + '-' + time.strftime('%Y%m%d-%H%M%S'))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def op_type(node_stats):
+    # timeline_label looks like 'name = Type(inputs)'
+    label = node_stats.timeline_label
+    if ' = ' not in label:
+        return node_stats.node_name
+    return label.split(' = ', 1)[1].split('(', 1)[0]
+
+def op_totals(traces):
+    """Total microseconds and count per op type and per node over all traced runs."""
+    by_type = defaultdict(lambda: [0, 0])
+    by_node = defaultdict(lambda: [0, 0])
+    for run_metadata in traces:
+        for dev_stats in run_metadata.step_stats.dev_stats:
+            # GPU stream stats repeat the kernels already listed under their device.
+            if 'stream:all' in dev_stats.device:
+                continue
+            for node_stats in dev_stats.node_stats:
+                micros = node_stats.all_end_rel_micros
+                by_type[op_type(node_stats)][0] += micros
+                by_type[op_type(node_stats)][1] += 1
+                by_node[node_stats.node_name][0] += micros
+                by_node[node_stats.node_name][1] += 1
+    return by_type, by_node
+
+def format_totals(title, totals, top):
+    total = sum(micros for micros, _ in totals.values()) or 1
+    lines = [title, '%10s %7s %9s  %s' % ('ms', '%', 'count', 'name')]
+    for name, (micros, count) in sorted(totals.items(), key=lambda item: -item[1][0])[:top]:
+        lines.append('%10.1f %6.1f%% %9d  %s' % (micros / 1000, 100 * micros / total, count, name))
+    return '\n'.join(lines)
+
+def save(path, traces, profiler=None, top=40):
+    """Write a chrome trace per session.run, a per-op summary and the python profile
+    to path. Returns the per op type summary."""
+    for i, run_metadata in enumerate(traces):
+        with open(os.path.join(path, 'timeline-%d.json' % i), 'w') as f:
+            f.write(timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format())
+    by_type, by_node = op_totals(traces)
+    summary = format_totals('Time by op type:', by_type, top)
+    with open(os.path.join(path, 'ops.txt'), 'w') as f:
+        f.write(summary + '\n\n' + format_totals('Time by node:', by_node, top) + '\n')
+    if profiler is not None:
+        profiler.dump_stats(os.path.join(path, 'python.prof'))
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(top)
+        with open(os.path.join(path, 'python.txt'), 'w') as f:
+            f.write(stream.getvalue())
+    logging.info('PROFILE WRITTEN TO ' + path)
+    return summary
@@ -9,6 +9,8 @@ def default_hparams():
         n_embd=768,
         n_head=12,
         n_layer=12,
+        # Storage type of the past keys/values, attention itself always runs in float32.
+        kv_dtype='float32',
     )
 
 def shape_list(x):
@@ -55,6 +57,14 @@ def conv1d(x, scope, nf, *, w_init_stdev=0.02):
         c = tf.reshape(tf.matmul(tf.reshape(x, [-1, nx]), tf.reshape(w, [-1, nf]))+b, start+[nf])
         return c
 
+def dense(x, scope, nf, *, w_init_stdev=0.02):
+    """conv1d for an input that is already [batch, features], without the reshapes around the matmul."""
+    with tf.variable_scope(scope):
+        nx = x.shape[-1].value
+        w = tf.get_variable('w', [1, nx, nf], initializer=tf.random_normal_initializer(stddev=w_init_stdev))
+        b = tf.get_variable('b', [nf], initializer=tf.constant_initializer(0))
+        return tf.matmul(x, w[0]) + b
+
 def attention_mask(nd, ns, *, dtype):
     """1's in the lower triangle, counting from the lower right corner.
     Same as tf.matrix_band_part(tf.ones([nd, ns]), -1, ns-nd), but doesn't produce garbage on TPUs.
@@ -102,7 +112,7 @@ def attn(x, scope, n_state, *, past, hparams):
         q, k, v = map(split_heads, tf.split(c, 3, axis=2))
         present = tf.stack([k, v], axis=1)
         if past is not None:
-            pk, pv = tf.unstack(past, axis=1)
+            pk, pv = tf.unstack(tf.cast(past, k.dtype), axis=1)
             k = tf.concat([pk, k], axis=-2)
             v = tf.concat([pv, v], axis=-2)
         a = multihead_attn(q, k, v)
@@ -111,6 +121,33 @@ def attn(x, scope, n_state, *, past, hparams):
         return a, present
 
 
+def attn_step(x, scope, n_state, *, past, hparams):
+    """attn for a single token per sequence, x is [batch, features].
+
+    One query attending to all of past needs no mask, and with a sequence length of 1
+    the heads can be split and merged with plain reshapes instead of transposes.
+    """
+    assert x.shape.ndims == 2  # Should be [batch, features]
+    assert n_state % hparams.n_head == 0
+    assert past.shape.ndims == 5  # Should be [batch, 2, heads, sequence, features], where 2 is [k, v]
+
+    with tf.variable_scope(scope):
+        c = dense(x, 'c_attn', n_state*3)
+        # [batch, 3, heads, 1, features], where 3 is [q, k, v]
+        c = tf.reshape(c, [-1, 3, hparams.n_head, 1, n_state // hparams.n_head])
+        q = c[:, 0]
+        present = c[:, 1:]
+        kv = tf.concat([tf.cast(past, present.dtype), present], axis=-2)
+        k, v = kv[:, 0], kv[:, 1]
+        w = tf.matmul(q, k, transpose_b=True)
+        w = w * tf.rsqrt(tf.cast(n_state // hparams.n_head, w.dtype))
+        w = softmax(w)
+        a = tf.matmul(w, v)
+        a = tf.reshape(a, [-1, n_state])
+        a = dense(a, 'c_proj', n_state)
+        return a, present
+
+
 def mlp(x, scope, n_state, *, hparams):
     with tf.variable_scope(scope):
         nx = x.shape[-1].value
@@ -128,6 +165,23 @@ def block(x, scope, *, past, hparams):
         x = x + m
         return x, present
 
+def mlp_step(x, scope, n_state, *, hparams):
+    with tf.variable_scope(scope):
+        nx = x.shape[-1].value
+        h = gelu(dense(x, 'c_fc', n_state))
+        h2 = dense(h, 'c_proj', nx)
+        return h2
+
+
+def block_step(x, scope, *, past, hparams):
+    with tf.variable_scope(scope):
+        nx = x.shape[-1].value
+        a, present = attn_step(norm(x, 'ln_1'), 'attn', nx, past=past, hparams=hparams)
+        x = x + a
+        m = mlp_step(norm(x, 'ln_2'), 'mlp', nx*4, hparams=hparams)
+        x = x + m
+        return x, present
+
 def past_shape(*, hparams, batch_size=None, sequence=None):
     return [batch_size, hparams.n_layer, 2, hparams.n_head, sequence, hparams.n_embd // hparams.n_head]
 
@@ -164,7 +218,7 @@ def model(hparams, X, past=None, scope='model', reuse=tf.AUTO_REUSE):
             if layer == 10:
                 tf.add_to_collection('checkpoints', h)
             presents.append(present)
-        results['present'] = tf.stack(presents, axis=1)
+        results['present'] = tf.cast(tf.stack(presents, axis=1), hparams.kv_dtype)
         h = norm(h, 'ln_f')
 
         # Language model loss.  Do tokens <n predict token n?
@@ -172,4 +226,31 @@ def model(hparams, X, past=None, scope='model', reuse=tf.AUTO_REUSE):
         logits = tf.matmul(h_flat, wte, transpose_b=True)
         logits = tf.reshape(logits, [batch, sequence, hparams.n_vocab])
         results['logits'] = logits
-        return results
\ No newline at end of file
+        return results
+
+
+def model_step(hparams, X, past, scope='model', reuse=tf.AUTO_REUSE):
+    """model for decoding one token per sequence, X is [batch] and past is required.
+    Returns logits as [batch, vocab] and present as [batch, layers, 2, heads, 1, features]."""
+    with tf.variable_scope(scope, reuse=reuse):
+        results = {}
+
+        wpe = tf.get_variable('wpe', [hparams.n_ctx, hparams.n_embd],
+                             initializer=tf.random_normal_initializer(stddev=0.01))
+        wte = tf.get_variable('wte', [hparams.n_vocab, hparams.n_embd],
+                             initializer=tf.random_normal_initializer(stddev=0.02))
+        past_length = tf.shape(past)[-2]
+        h = tf.gather(wte, X) + wpe[past_length]
+
+        # Transformer
+        presents = []
+        pasts = tf.unstack(past, axis=1)
+        assert len(pasts) == hparams.n_layer
+        for layer, past in enumerate(pasts):
+            h, present = block_step(h, 'h%d' % layer, past=past, hparams=hparams)
+            presents.append(present)
+        results['present'] = tf.cast(tf.stack(presents, axis=1), hparams.kv_dtype)
+        h = norm(h, 'ln_f')
+
+        results['logits'] = tf.matmul(h, wte, transpose_b=True)
+        return results
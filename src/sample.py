@@ -36,7 +36,15 @@ def top_p_logits(logits, p):
         )
 
 
-def sample_sequence(*, hparams, length, start_token=None, batch_size=None, context=None, temperature=1, top_k=0, top_p=0.0):
+def sample_sequence(*, hparams, length, start_token=None, batch_size=None, context=None, temperature=1, top_k=0, top_p=0.0, prefill_chunk=None, past=None, return_presents=False, stop=None):
+    """Sample length tokens after context, or after start_token.
+
+    past holds the presents of tokens that came before context, so only context has to be
+    prefilled. With return_presents the presents of everything fed to the model (past,
+    context and all but the last sampled token) are returned alongside the tokens.
+    stop is a function returning a boolean tensor, called in the loop condition so it is
+    evaluated again before every token. Sampling ends early once it is true.
+    """
     if start_token is None:
         assert context is not None, 'Specify exactly one of start_token and context!'
     else:
@@ -54,15 +62,55 @@ def sample_sequence(*, hparams, length, start_token=None, batch_size=None, conte
             'presents': presents,
         }
 
+    def decode_step(hparams, tokens, past):
+        lm_output = model.model_step(hparams=hparams, X=tokens, past=past, reuse=tf.AUTO_REUSE)
+
+        logits = lm_output['logits'][:, :hparams.n_vocab]
+        presents = lm_output['present']
+        presents.set_shape(model.past_shape(hparams=hparams, batch_size=batch_size, sequence=1))
+        return {
+            'logits': logits,
+            'presents': presents,
+        }
+
+    def prefill(tokens, past):
+        # Feed the context through the model prefill_chunk tokens at a time, so peak
+        # activation memory depends on the chunk size rather than the prompt length.
+        if past is None:
+            past = tf.zeros(model.past_shape(hparams=hparams, batch_size=model.shape_list(tokens)[0], sequence=0), dtype=hparams.kv_dtype)
+
+        def chunk_cond(i, past):
+            return i < tf.shape(tokens)[1]
+
+        def chunk_body(i, past):
+            presents = step(hparams, tokens[:, i:i + prefill_chunk], past=past)['presents']
+            return [i + prefill_chunk, tf.concat([past, presents], axis=-2)]
+
+        _, presents = tf.while_loop(
+            cond=chunk_cond, body=chunk_body,
+            loop_vars=[tf.constant(0), past],
+            shape_invariants=[
+                tf.TensorShape([]),
+                tf.TensorShape(model.past_shape(hparams=hparams, batch_size=batch_size)),
+            ],
+            back_prop=False,
+        )
+        return presents
+
     with tf.name_scope('sample_sequence'):
         # Don't feed the last context token -- leave that to the loop below
         # TODO: Would be slightly faster if we called step on the entire context,
         # rather than leaving the last token transformer calculation to the while loop.
-        context_output = step(hparams, context[:, :-1])
+        if prefill_chunk is None:
+            context_presents = step(hparams, context[:, :-1], past=past)['presents']
+            if past is not None:
+                context_presents = tf.concat([past, context_presents], axis=-2)
+        else:
+            context_presents = prefill(context[:, :-1], past)
 
         def body(past, prev, output):
-            next_outputs = step(hparams, prev[:, tf.newaxis], past=past)
-            logits = next_outputs['logits'][:, -1, :]  / tf.to_float(temperature)
+            next_outputs = decode_step(hparams, prev, past)
+            logits = next_outputs['logits'] / tf.to_float(temperature)
             if top_p > 0.0:
                 logits = top_p_logits(logits, p=top_p)
             else:
@@ -75,13 +123,15 @@ def sample_sequence(*, hparams, length, start_token=None, batch_size=None, conte
             ]
 
         def cond(*args):
-            return True
+            if stop is None:
+                return True
+            return tf.logical_not(stop())
 
-        _, _, tokens = tf.while_loop(
+        presents, _, tokens = tf.while_loop(
             cond=cond, body=body,
             maximum_iterations=length,
             loop_vars=[
-                context_output['presents'],
+                context_presents,
                 context[:, -1],
                 context,
             ],
@@ -93,4 +143,6 @@ def sample_sequence(*, hparams, length, start_token=None, batch_size=None, conte
             back_prop=False,
         )
 
+        if return_presents:
+            return tokens, presents
         return tokens
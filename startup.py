@@ -0,0 +1,64 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from gpt2_server_sessions import stored_model_name
+
+# session, graph and restore are only spent by the guild that loads a model, the others wait
+# for it and attach to the loaded one, see gpt2_server_sessions.SharedModels.
+PHASES = ('preinit', 'session', 'graph', 'restore', 'shared')
+
+class StartupPipeline:
+    """Loads guild sessions on background workers instead of the event loop.
+
+    Guilds are grouped by model. The first guild of every model loads it, in parallel with
+    the other models, and the remaining guilds of that model then share the loaded graph
+    and session, so every model is built and restored once. on_loaded
+    is called on the event loop as each guild's session becomes ready, on_failed with the
+    exception for a guild that couldn't be loaded.
+    """
+
+    def __init__(self, loop, session_factory, on_loaded, on_failed, workers=4):
+        self.loop = loop
+        self.session_factory = session_factory
+        self.on_loaded = on_loaded
+        self.on_failed = on_failed
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='gpt2-startup')
+        self.loading = set()
+
+    async def load(self, guild_ids):
+        guild_ids = [guild_id for guild_id in guild_ids if guild_id not in self.loading]
+        if not guild_ids:
+            return
+        self.loading.update(guild_ids)
+        start = time.time()
+        groups = OrderedDict()
+        for guild_id in guild_ids:
+            groups.setdefault(stored_model_name(guild_id), []).append(guild_id)
+        logging.info('STARTUP: loading ' + str(len(guild_ids)) + ' guilds on ' + ', '.join(
+            model_name + ' (' + str(len(ids)) + ')' for model_name, ids in groups.items()))
+        await asyncio.gather(*(self.load_group(model_name, ids) for model_name, ids in groups.items()))
+        logging.info('STARTUP: done in ' + str(round(time.time() - start, 2)) + ' seconds.')
+
+    async def load_group(self, model_name, guild_ids):
+        start = time.time()
+        timings = [await self.load_guild(guild_ids[0])]
+        timings += await asyncio.gather(*(self.load_guild(guild_id) for guild_id in guild_ids[1:]))
+        totals = {phase: sum(t.get(phase, 0) for t in timings if t) for phase in PHASES}
+        logging.info('STARTUP ' + model_name + ': ' + str(len(guild_ids)) + ' guilds in ' + str(round(time.time() - start, 2)) + ' seconds, '
+            + ', '.join(phase + ' ' + str(round(seconds, 2)) + 's' for phase, seconds in totals.items()) + ' summed over workers.')
+
+    async def load_guild(self, guild_id):
+        try:
+            session = await self.loop.run_in_executor(self.executor, self.session_factory, guild_id)
+        except Exception as e:
+            logging.error('STARTUP: failed to load guild ' + str(guild_id) + ': ' + str(e))
+            self.on_failed(guild_id, e)
+            return None
+        finally:
+            self.loading.discard(guild_id)
+        logging.info('STARTUP: guild ' + str(guild_id) + ' ready, ' + ', '.join(
+            phase + ' ' + str(round(seconds, 2)) + 's' for phase, seconds in session.timings.items()))
+        self.on_loaded(guild_id, session)
+        return session.timings